@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+# Offline benchmarks for update.py.
+#
+# Generate a synthetic dataset, then time the stages of a run against it:
+#
+#   python3 benchmark.py generate fixtures.json --packages 50000
+#   python3 benchmark.py run fixtures.json
+#
+# "python3 benchmark.py startup" times how long update.py takes to start
+# and answer a CGI request, and fails if that loads any of the server
+# libraries.
+#
+# Fixtures recorded from the real servers with [replay] mode = record in
+# update.ini can be benchmarked the same way.  Both commands have to use the
+# same [copr] and [concurrency] settings, since they decide which pages are
+# requested.
+
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import update
+
+KOJI_EVENT = {'id' : 1000000, 'ts' : 1700000000.0}
+
+def synthetic_version(rnd):
+    return '{}.{}.{}'.format(rnd.randint(0, 20), rnd.randint(0, 50), rnd.randint(0, 9))
+
+class SyntheticKojiSession:
+    def __init__(self, num_packages, seed):
+        self.num_packages = num_packages
+        self.seed = seed
+
+    def hello(self):
+        return 'Hello!'
+
+    def getLastEvent(self):
+        return KOJI_EVENT
+
+    def listTagged(self, tag, inherit = False, latest = False, package = None, event = None):
+        base_tag = tag.split('-')[0]
+        rnd = random.Random('{}-{}'.format(self.seed, base_tag))
+        builds = []
+        for i in range(self.num_packages):
+            name = 'package{:06d}'.format(i)
+            nvr = '{}-{}-{}.fc{}'.format(name, synthetic_version(rnd), rnd.randint(1, 5), base_tag[1:])
+            tag_name = tag if rnd.random() < 0.3 else base_tag
+            if rnd.random() < 0.02:
+                continue
+            if package and package != name:
+                continue
+            builds.append({'name' : name, 'nvr' : nvr, 'build_id' : i, 'tag_name' : tag_name})
+        return builds
+
+class SyntheticPackageProxy:
+    def __init__(self, num_packages, seed):
+        self.num_packages = num_packages
+        self.seed = seed
+
+    def get_list(self, owner, project, pagination = None, with_latest_succeeded_build = False,
+                 with_latest_build = False):
+        rnd = random.Random('{}-{}'.format(self.seed, project))
+        pkgs = []
+        for i in range(self.num_packages):
+            name = 'package{:06d}'.format(i)
+            version = '{}-{}.fc{}'.format(synthetic_version(rnd), rnd.randint(1, 5), project[-2:])
+            passes = rnd.random() < 0.9
+            if rnd.random() < 0.05:
+                continue
+            build = {'id' : i, 'source_package' : {'name' : name, 'version' : version}}
+            pkgs.append({'name' : name,
+                         'builds' : {'latest' : build,
+                                     'latest_succeeded' : build if passes else None}})
+        offset = pagination['offset']
+        return pkgs[offset:offset + pagination['limit']]
+
+class SyntheticBaseProxy:
+    def home(self):
+        return {}
+
+class SyntheticCoprClient:
+    def __init__(self, num_packages, seed):
+        self.base_proxy = SyntheticBaseProxy()
+        self.package_proxy = SyntheticPackageProxy(num_packages, seed)
+
+def get_config(mode, filename, cache_dir):
+    config = update.load_config()
+    config['replay']['mode'] = mode
+    config['replay']['file'] = filename
+    config['cache']['dir'] = cache_dir
+    return config
+
+def fetch_all():
+    sources = update.Sources()
+    for comparison in update.get_comparisons(sources):
+        comparison.baseline.packages.result()
+        comparison.test.packages.result()
+    return sources
+
+# Record a run against the synthetic servers.
+def generate(args):
+    rnd = random.Random(args.seed)
+    br_pkgs = ['package{:06d}'.format(i) for i in range(args.packages) if rnd.random() < 0.9]
+
+    update.create_koji_session = lambda url : SyntheticKojiSession(args.packages, args.seed)
+    update.create_copr_client = lambda url : SyntheticCoprClient(args.packages, args.seed)
+    names = ['package{:06d}'.format(i) for i in range(args.packages)]
+    # Each package is build required by a few packages after it.
+    edges = set((i, j) for i in range(args.packages) for j in rnd.sample(range(i, args.packages),
+                                                                        min(3, args.packages - i)) if i != j)
+    graph = update.get_impact_graph_data(names, edges)
+    update.load_eln_data = lambda : {'pkgs' : br_pkgs, 'graph' : graph}
+    update.get_repomd_checksum = lambda url : hashlib.sha256('{}{}'.format(args.seed, url).encode()).hexdigest()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        update.setup(get_config('record', args.fixtures, cache_dir))
+        fetch_all()
+        update.shutdown()
+    print('Wrote', args.fixtures)
+
+def timed(results, name, fn, *args):
+    start = time.time()
+    value = fn(*args)
+    results.setdefault(name, []).append(time.time() - start)
+    return value
+
+def run(args):
+    results = {}
+    for i in range(args.repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            update.setup(get_config('replay', args.fixtures, cache_dir))
+            sources = timed(results, 'get_packages', fetch_all)
+            for comparison in update.get_comparisons(sources):
+                file_prefix = comparison.name
+                baseline_pkgs = comparison.baseline.packages.result()
+                test_pkgs = comparison.test.packages.result()
+                stats, pkg_compare_list = timed(results, 'compare ' + file_prefix, update.compare_packages,
+                                                baseline_pkgs, test_pkgs, comparison.test.get_package_base_link(),
+                                                None, comparison.uses_copr())
+                if update.impact_graph:
+                    failed = [c.pkg.name for c in pkg_compare_list
+                              if c.get_other_pkg_status() != update.PkgCompare.STATUS_PASS]
+                    timed(results, 'impact ' + file_prefix, update.impact_graph.get_impact, failed)
+                timed(results, 'stats ' + file_prefix, stats.html_table)
+                timed(results, 'render ' + file_prefix,
+                      lambda : ''.join(update.render_page(file_prefix, stats, pkg_compare_list)))
+            update.shutdown()
+
+    print('{:<32} {:>10} {:>10}'.format('benchmark', 'min (s)', 'mean (s)'))
+    for name, times in results.items():
+        print('{:<32} {:>10.4f} {:>10.4f}'.format(name, min(times), sum(times) / len(times)))
+
+# Modules that a CGI request that only queues or polls a job should never
+# need.
+SERVER_MODULES = ['dnf', 'hawkey', 'koji', 'copr', 'requests', 'rpm']
+
+IMPORT_TIME = """
+import sys, time
+start = time.perf_counter()
+import update
+print(time.perf_counter() - start)
+"""
+
+CGI_REQUEST = """
+import runpy, sys
+runpy.run_path(sys.argv[1], run_name = '__main__')
+print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in sys.argv[2:])), file = sys.stderr)
+"""
+
+def startup(args):
+    update_dir = os.path.dirname(os.path.abspath(update.__file__))
+    results = {}
+    loaded = set()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, GATEWAY_INTERFACE = 'CGI/1.1', QUERY_STRING = 'job=0',
+                   PYTHONPATH = os.pathsep.join([update_dir, os.environ.get('PYTHONPATH', '')]))
+        for i in range(args.repeat):
+            p = subprocess.run([sys.executable, '-c', IMPORT_TIME], cwd = workdir, env = env,
+                               stdout = subprocess.PIPE, check = True, universal_newlines = True)
+            results.setdefault('import update', []).append(float(p.stdout))
+
+            start = time.time()
+            p = subprocess.run([sys.executable, '-c', CGI_REQUEST, update.__file__] + SERVER_MODULES,
+                               cwd = workdir, env = env, stdout = subprocess.DEVNULL,
+                               stderr = subprocess.PIPE, check = True, universal_newlines = True)
+            results.setdefault('cgi job status', []).append(time.time() - start)
+            loaded.update(p.stderr.split())
+
+    print('{:<32} {:>10} {:>10}'.format('benchmark', 'min (s)', 'mean (s)'))
+    for name, times in results.items():
+        print('{:<32} {:>10.4f} {:>10.4f}'.format(name, min(times), sum(times) / len(times)))
+
+    failed = False
+    if loaded:
+        print('CGI request loaded', ' '.join(sorted(loaded)), file = sys.stderr)
+        failed = True
+    if args.max_seconds and min(results['cgi job status']) > args.max_seconds:
+        print('CGI request took longer than {}s'.format(args.max_seconds), file = sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Offline benchmarks for update.py')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    p = subparsers.add_parser('generate', help = 'Generate a synthetic fixtures file')
+    p.add_argument('fixtures')
+    p.add_argument('--packages', type = int, default = 10000, help = 'Packages per tag')
+    p.add_argument('--seed', type = int, default = 0)
+    p.set_defaults(func = generate)
+
+    p = subparsers.add_parser('run', help = 'Time a run replayed from a fixtures file')
+    p.add_argument('fixtures')
+    p.add_argument('--repeat', type = int, default = 3)
+    p.set_defaults(func = run)
+
+    p = subparsers.add_parser('startup', help = 'Time the start of a CGI request')
+    p.add_argument('--repeat', type = int, default = 5)
+    p.add_argument('--max-seconds', type = float, help = 'Fail if a request takes longer than this')
+    p.set_defaults(func = startup)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,38 +1,412 @@
 #!/usr/bin/python3
 
-import cgi
-import cgitb
-import dnf
-import rpm
-import koji
+# dnf, koji and copr take a while to import, so they are only imported by
+# the code that talks to the servers.  A CGI request that only queues a job
+# or polls one never loads them.
 import re
 import datetime
 import concurrent.futures
 import configparser
-import urllib.request
 import io
-from dnf.subject import Subject
-import hawkey
-from copr.v3 import Client
 import threading
 import time
 import os
 import sys
 import subprocess
+import shutil
+import contextlib
+import fcntl
+import uuid
+import hashlib
+import json
+import functools
+import gzip
+import array
+import sqlite3
+import random
+import urllib.parse
+
+# Return a future for fn(*results) that runs as soon as all the futures are
+# done, without tying up an executor thread while it waits.
+def combine_futures(fn, *futures):
+    combined = concurrent.futures.Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        combined.set_running_or_notify_cancel()
+        try:
+            combined.set_result(fn(*[f.result() for f in futures]))
+        except Exception as e:
+            combined.set_exception(e)
+
+    for f in futures:
+        f.add_done_callback(done)
+    return combined
+
+class Phase:
+    def __init__(self):
+        self.items = 0
+
+# Wall time, call counts and item counts for each phase of a run, per source.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, source = ''):
+        p = Phase()
+        start = time.time()
+        try:
+            yield p
+        finally:
+            self.add(name, source, time.time() - start, 1, p.items)
+
+    def add(self, name, source, seconds = 0, calls = 0, items = 0):
+        with self.lock:
+            m = self.phases.setdefault((name, source), {'seconds' : 0, 'calls' : 0, 'items' : 0})
+            m['seconds'] += seconds
+            m['calls'] += calls
+            m['items'] += items
+
+    # Start over, for each refresh of a long running daemon.
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.phases = {}
+
+    def as_dict(self):
+        with self.lock:
+            phases = [dict(phase = name, source = source, **m) for (name, source), m in sorted(self.phases.items())]
+        return {'start' : self.start,
+                'seconds' : time.time() - self.start,
+                'phases' : phases}
+
+    def prometheus(self):
+        data = self.as_dict()
+        yield '# HELP clang_status_run_seconds Wall time of the whole run.\n'
+        yield '# TYPE clang_status_run_seconds gauge\n'
+        yield 'clang_status_run_seconds {:.3f}\n'.format(data['seconds'])
+        for key, help in [('seconds', 'Wall time spent in each phase.'),
+                          ('calls', 'Number of times each phase ran.'),
+                          ('items', 'Number of items each phase handled.')]:
+            yield '# HELP clang_status_phase_{} {}\n'.format(key, help)
+            yield '# TYPE clang_status_phase_{} gauge\n'.format(key)
+            for p in data['phases']:
+                yield 'clang_status_phase_{}{{phase="{}",source="{}"}} {}\n'.format(
+                        key, p['phase'], p['source'], p[key])
+
+    def write(self):
+        write_json(os.path.join(cache_dir, config['metrics']['file']), self.as_dict())
+        if config['metrics']['prometheus']:
+            write_file(config['metrics']['prometheus'], self.prometheus())
+
+# Stores the result of every server call made during a run, so the run can
+# later be replayed offline.
+class Fixtures:
+    VERSION = 1
+
+    def __init__(self, filename, mode):
+        if mode not in ['record', 'replay']:
+            raise ValueError('Unknown replay mode: {}'.format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.calls = {}
+        if mode == 'replay':
+            data = read_json(filename)
+            if not data or data.get('version') != self.VERSION:
+                raise ValueError('Cannot load fixtures from {}'.format(filename))
+            self.calls = data['calls']
+
+    def call(self, source, method, fn, *args, **kwargs):
+        key = json.dumps([source, method, args, kwargs], sort_keys = True)
+        if self.mode == 'replay':
+            if key not in self.calls:
+                raise KeyError('No recorded result for {}'.format(key))
+            return self.calls[key]
+        result = fn(*args, **kwargs)
+        with self.lock:
+            self.calls[key] = result
+        return result
+
+    def save(self):
+        if self.mode == 'record':
+            write_file(self.filename, [json.dumps({'version' : self.VERSION, 'calls' : self.calls},
+                                                  default = str)])
+
+# Stands in for a Koji session or Copr client and passes every method call
+# through fixtures.  When replaying there is no client behind it at all.
+class Recorder:
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def __getattr__(self, attr):
+        target = getattr(self.target, attr) if self.target is not None else None
+        # Copr's client groups its calls into proxy objects.
+        if attr.endswith('_proxy'):
+            return Recorder('{}.{}'.format(self.source, attr), target)
+        if attr == 'multicall':
+            return lambda **kwargs : MultiCallRecorder(self)
+        return lambda *args, **kwargs : fixtures.call(self.source, attr, target, *args, **kwargs)
+
+class RecordedCall:
+    def __init__(self, result):
+        self.result = result
+
+# Koji multicalls are recorded as the individual calls they contain.
+class MultiCallRecorder:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __getattr__(self, attr):
+        method = getattr(self.recorder, attr)
+        return lambda *args, **kwargs : RecordedCall(method(*args, **kwargs))
+
+class CircuitOpenError(Exception):
+    pass
+
+# Stops calls to a server that keeps failing for a while, so that every
+# request doesn't have to wait through its own timeouts and retries.
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+
+    def check(self):
+        with self.lock:
+            if self.open_until > time.time():
+                raise CircuitOpenError('{} is failing, not trying again until {}'.format(
+                        self.host, time.strftime('%H:%M:%S', time.localtime(self.open_until))))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            # After the reset time every call is let through again, but
+            # the count isn't reset, so the first one to fail opens it
+            # again right away.
+            if self.failures >= config.getint('fetch', 'breaker_failures'):
+                self.open_until = time.time() + config.getint('fetch', 'breaker_reset')
+                metrics.add('circuit_open', self.host)
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(host):
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker(host)
+        return breakers[host]
+
+# Only connection problems and timeouts are worth another try.  An error
+# from the server itself, like a koji.GenericError for a missing tag, would
+# just fail again.  Copr wraps its connection errors in its own exception.
+def is_transient_error(e):
+    if isinstance(e, OSError):
+        return True
+    copr = sys.modules.get('copr.v3')
+    return bool(copr) and isinstance(e, copr.CoprRequestException)
+
+# Call fn in a thread of its own and give up on it after timeout seconds,
+# for clients that don't have a timeout setting.  The thread is left to
+# finish by itself.
+def call_with_timeout(timeout, fn, *args, **kwargs):
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target = run, daemon = True).start()
+    try:
+        return future.result(timeout = timeout)
+    except concurrent.futures.TimeoutError:
+        raise TimeoutError('no answer after {}s'.format(timeout))
+
+# Call fn, retrying failures with exponential backoff.  The delay is
+# randomized so that concurrent requests don't all retry at once.
+def call_with_retry(host, fn, *args, **kwargs):
+    breaker = get_breaker(host)
+    retries = config.getint('fetch', 'retries')
+    for attempt in range(retries + 1):
+        breaker.check()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not is_transient_error(e):
+                # The server answered, so it is up.
+                breaker.success()
+                raise
+            breaker.failure()
+            if attempt == retries:
+                raise
+            delay = min(config.getfloat('fetch', 'backoff') * 2 ** attempt, config.getfloat('fetch', 'max_backoff'))
+            delay = random.uniform(delay / 2, delay)
+            print('{} failed: {}, retrying in {:.1f}s'.format(host, str(e), delay), file = sys.stderr)
+            metrics.add('retry', host)
+            time.sleep(delay)
+            continue
+        breaker.success()
+        return result
+
+# Passes every method call of a Koji session or Copr client through
+# call_with_retry(), and through call_with_timeout() if timeout is set.
+class RetryingClient:
+    def __init__(self, host, target, timeout = None):
+        self.host = host
+        self.target = target
+        self.timeout = timeout
+
+    def __getattr__(self, attr):
+        target = getattr(self.target, attr)
+        if attr.endswith('_proxy'):
+            return RetryingClient(self.host, target, self.timeout)
+        # The calls in a multicall are only sent at the end of the block.
+        if attr == 'multicall':
+            return target
+        if self.timeout:
+            return lambda *args, **kwargs : call_with_retry(self.host, call_with_timeout, self.timeout, target,
+                                                            *args, **kwargs)
+        return lambda *args, **kwargs : call_with_retry(self.host, target, *args, **kwargs)
+
+def get_host(url):
+    return urllib.parse.urlparse(url).netloc
+
+def record(source, method, fn, *args, **kwargs):
+    if not fixtures:
+        return fn(*args, **kwargs)
+    return fixtures.call(source, method, fn, *args, **kwargs)
+
+def create_koji_session(koji_url):
+    import koji
+    return koji.ClientSession(koji_url, opts = {'timeout' : config.getint('fetch', 'timeout')})
+
+def create_copr_client(url):
+    from copr.v3 import Client
+    return Client({'copr_url' : url})
+
+# Koji sessions aren't documented as thread safe, so each source gets its
+# own client, and keeps reusing its connections.
+def create_client(source, create, url, timeout = None):
+    if fixtures and fixtures.mode == 'replay':
+        return Recorder(source, None)
+    client = RetryingClient(get_host(url), create(url), timeout)
+    if fixtures:
+        return Recorder(source, client)
+    return client
+
+class Results:
+    def __init__(self):
+        self.future = None
+        # When the package list is the saved one, the time it was saved.
+        self.stale = None
+        # Hash of the whole listing the package list was made from, for
+        # sources that have one.
+        self.listing_digest = None
+
+    # Fetching starts on first use, so sources that only appear in
+    # comparisons that weren't requested are never contacted.
+    @property
+    def packages(self):
+        if not self.future:
+            self.future = self.start_with_fallback()
+        return self.future
+
+    # Throw away the current package list and fetch a new one.
+    def refresh(self):
+        self.future = self.start_with_fallback()
+        return self.future
+
+    def get_saved_file(self):
+        name = re.sub('[^A-Za-z0-9.-]+', '-', get_source_label(self)).strip('-')
+        return os.path.join(cache_dir, 'packages-{}-{}.json'.format(self.kind, name))
+
+    # Every successful fetch is saved, so that when the server can't be
+    # reached the pages can be made from the last package list instead.
+    def start_with_fallback(self):
+        result = concurrent.futures.Future()
+
+        # start() can take a while to retry, so don't wait for it here.
+        def started(future):
+            try:
+                future.result().add_done_callback(done)
+            except Exception:
+                done(future)
+
+        def done(future):
+            result.set_running_or_notify_cancel()
+            try:
+                pkgs = future.result()
+                if not pkgs:
+                    raise ValueError('no packages')
+                with metrics.phase('save_packages', get_source_label(self)):
+                    write_json(self.get_saved_file(), {'time' : time.time(),
+                                                       'packages' : [self.pkg_to_row(p) for p in pkgs.values()]})
+                self.stale = None
+            except Exception as e:
+                print(get_source_label(self), str(e), file = sys.stderr)
+                pkgs = self.load_saved()
+            result.set_result(pkgs)
+
+        executors['jobs'].submit(self.start).add_done_callback(started)
+        return result
+
+    def load_saved(self):
+        saved = read_json(self.get_saved_file())
+        if not saved:
+            return {}
+        print(get_source_label(self), 'using the package list from',
+              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(saved['time'])), file = sys.stderr)
+        self.stale = saved['time']
+        self.listing_digest = None
+        return {row[0] : self.row_to_pkg(row) for row in saved['packages']}
+
+class CoprResults(Results):
+    kind = 'copr'
 
-class CoprResults:
     def __init__(self, url, owner, project):
+        super(CoprResults, self).__init__()
         self.url = url
-        config = {'copr_url': url  }
-        self.client = Client(config)
+        # The Copr client has no timeout setting of its own.
+        self.client = create_client('copr:' + url, create_copr_client, url, config.getint('fetch', 'timeout'))
         self.owner = owner
         self.project = project
-        try:
+
+    def get_source_name(self):
+        return '{}/{}'.format(self.owner, self.project)
+
+    def start(self):
+        with metrics.phase('copr_home', self.get_source_name()):
             self.client.base_proxy.home()
-            self.packages = executor.submit(self.get_packages, clang_gcc_br_pkgs_fedora)
-        except Exception as e:
-            print(project, str(e), file = sys.stderr)
-            self.packages = executor.submit(lambda : {})
+        return executors['jobs'].submit(self.get_packages, get_clang_gcc_br_pkgs())
+
+    def pkg_to_row(self, pkg):
+        return [pkg.name, pkg.nvr, pkg.build_id, pkg.build_passes]
+
+    def row_to_pkg(self, row):
+        return CoprPkg(row[0], row[1], row[2], self, row[3])
 
     def get_build_link(self, pkg_id):
         return '{}/coprs/{}/{}/build/{}/'.format(self.url, self.owner.replace('@','g/'), self.project, pkg_id)
@@ -43,9 +417,18 @@ class CoprResults:
     def get_package_link(self, pkg):
         return '{}{}'.format(self.get_package_base_link(), pkg.name)
 
-    def get_packages(self, clang_gcc_br_pkgs_fedoran):
-        pkgs = {}
-        for p in self.client.package_proxy.get_list(self.owner, self.project, with_latest_succeeded_build=True, with_latest_build=True):
+    def get_page(self, offset, limit):
+        pagination = {'limit' : limit, 'offset' : offset, 'order' : 'id', 'order_type' : 'ASC'}
+        with metrics.phase('copr_get_list', self.get_source_name()) as m:
+            page = self.client.package_proxy.get_list(self.owner, self.project, pagination = pagination,
+                                                      with_latest_succeeded_build=True, with_latest_build=True)
+            m.items = len(page)
+        pkgs = []
+        listing = []
+        for p in page:
+            latest = p['builds']['latest'] or {}
+            latest_succeeded = p['builds']['latest_succeeded'] or {}
+            listing.append([p['name'], latest.get('id'), latest.get('state'), latest_succeeded.get('id')])
             build_passes = True
             pkg =  p['builds']['latest_succeeded']
             if not pkg:
@@ -53,62 +436,309 @@ class CoprResults:
                 if not pkg:
                     continue
                 build_passes = False
-            pkg['copr'] = self
             src_version = pkg['source_package']['version']
-            pkg['nvr'] = "{}-{}".format(p['name'], src_version)
-            pkg['name'] = p['name']
-            pkgs[p['name']] = CoprPkg(pkg, self, build_passes)
-        return pkgs
+            nvr = "{}-{}".format(p['name'], src_version)
+            pkgs.append(CoprPkg(p['name'], nvr, pkg['id'], self, build_passes))
+        return pkgs, listing, len(page) == limit
 
-    def get_file_prefix(self, is_baseline):
-        if is_baseline:
-            return None
-        return self.project
+    def get_packages(self, clang_gcc_br_pkgs_fedora):
+        page_size = config.getint('copr', 'page_size')
+        num_pages = config.getint('concurrency', 'copr')
+        pkgs = {}
+        listing = []
+        offset = 0
+        last_page = False
+        # We don't know how many packages there are, so request pages in
+        # batches until one of them comes back short.
+        while not last_page:
+            pages = [executors['copr'].submit(self.get_page, offset + i * page_size, page_size) for i in range(num_pages)]
+            offset += num_pages * page_size
+            for page in concurrent.futures.as_completed(pages):
+                page_pkgs, page_listing, full = page.result()
+                listing.extend(page_listing)
+                last_page = last_page or not full
+                clang_gcc_br_pkgs = None
+                if clang_gcc_br_pkgs_fedora.done():
+                    clang_gcc_br_pkgs = clang_gcc_br_pkgs_fedora.result()
+                for pkg in page_pkgs:
+                    if clang_gcc_br_pkgs is None or pkg.name in clang_gcc_br_pkgs:
+                        pkgs[pkg.name] = pkg
+
+        # Every package and its latest build, whatever the BuildRequires.
+        self.listing_digest = hashlib.sha256(json.dumps(sorted(listing)).encode()).hexdigest()
+
+        # Catch anything that came in before the BuildRequires set was ready.
+        clang_gcc_br_pkgs = clang_gcc_br_pkgs_fedora.result()
+        return {name : pkg for name, pkg in pkgs.items() if name in clang_gcc_br_pkgs}
+
+def get_build_info(p):
+    # The parts of a Koji build record that we keep in the snapshot.
+    return {'name' : p['name'],
+            'nvr' : p['nvr'],
+            'build_id' : p['build_id'],
+            'tag_name' : p['tag_name']}
+
+class KojiResults(Results):
+    kind = 'koji'
 
-class KojiResults:
     def __init__(self, tag, koji_url = 'https://koji.fedoraproject.org/kojihub'):
+        super(KojiResults, self).__init__()
         self.tag = tag
-        self.session = koji.ClientSession(koji_url)
-        try:
+        self.session = create_client('koji:' + koji_url, create_koji_session, koji_url)
+
+    def start(self):
+        with metrics.phase('koji_hello', self.tag):
             self.session.hello()
-            self.packages = executor.submit(self.get_packages, clang_gcc_br_pkgs_fedora)
-        except Exception as e:
-            print(tag, str(e), file = sys.stderr)
-            self.packages = executor.submit(lambda : {})
+        # Only the filtering needs the BuildRequires set, so don't make
+        # the Koji query wait for it.
+        builds = executors['koji'].submit(self.get_tagged_builds)
+        return combine_futures(self.get_packages, builds, get_clang_gcc_br_pkgs())
 
+    def pkg_to_row(self, pkg):
+        return [pkg.name, pkg.nvr, pkg.build_id, pkg.tag_name]
+
+    def row_to_pkg(self, row):
+        return KojiPkg(row[0], row[1], row[2], row[3], KOJI_WEBURL)
 
     def get_package_base_link(self):
-        return "'https://koji.fedoraproject.org/koji/search?type=package&match=glob&terms="
+        return KOJI_WEBURL + KOJI_PACKAGE_SEARCH
+
+    def list_tagged(self, tag, event, package = None):
+        builds = {}
+        with metrics.phase('koji_list_tagged', self.tag) as m:
+            for p in self.session.listTagged(tag = tag, inherit = True, latest = True,
+                                             package = package, event = event):
+                builds[p['name']] = get_build_info(p)
+            m.items = len(builds)
+        return builds
+
+    def update_snapshot(self, tag, snapshot, event):
+        # Find every package whose tagging changed in the tag or one of its
+        # parents since the snapshot was taken.
+        tags = [tag] + [t['name'] for t in self.session.getFullInheritance(tag)]
+        changed = set()
+        for t in tags:
+            with metrics.phase('koji_query_history', self.tag) as m:
+                history = self.session.queryHistory(tables = ['tag_listing', 'tag_inheritance'], tag = t,
+                                                    afterEvent = snapshot['event'],
+                                                    beforeEvent = event + 1)
+                m.items = len(history.get('tag_listing', []))
+            if history.get('tag_inheritance'):
+                # The inheritance chain changed, so the snapshot can't be patched.
+                return None
+            for h in history.get('tag_listing', []):
+                changed.add(h['name'])
+
+        if len(changed) > config.getint('koji', 'max_changes'):
+            return None
 
-    def get_packages(self, clang_gcc_br_pkgs_fedora):
-        clang_gcc_br_pkgs = clang_gcc_br_pkgs_fedora
+        builds = snapshot['builds']
+        with metrics.phase('koji_multicall', self.tag) as p:
+            with self.session.multicall(strict = True) as m:
+                calls = [(name, m.listTagged(tag = tag, inherit = True, latest = True,
+                                             package = name, event = event)) for name in changed]
+            p.items = len(calls)
+        for name, call in calls:
+            builds.pop(name, None)
+            for p in call.result:
+                builds[p['name']] = get_build_info(p)
+        print(tag, 'incremental update,', len(changed), 'packages changed', file = sys.stderr)
+        return builds
+
+    def get_tagged_builds(self):
         tag = "{}-updates".format(self.tag)
+        snapshot_file = os.path.join(cache_dir, 'koji-{}.json'.format(tag))
+        snapshot = read_json(snapshot_file)
+        with metrics.phase('koji_last_event', self.tag):
+            event = self.session.getLastEvent()
+
+        if snapshot and snapshot['event'] == event['id']:
+            return snapshot['builds'].values()
+
+        builds = None
+        if snapshot and event['ts'] - snapshot['ts'] < 3600 * config.getfloat('koji', 'snapshot_max_age'):
+            builds = self.update_snapshot(tag, snapshot, event['id'])
+        if builds is None:
+            print(tag, 'full refresh', file = sys.stderr)
+            builds = self.list_tagged(tag, event['id'])
+
+        write_json(snapshot_file, {'event' : event['id'], 'ts' : event['ts'], 'builds' : builds})
+        return builds.values()
+
+    def get_packages(self, builds, clang_gcc_br_pkgs):
         pkgs = {}
-        for p in self.session.listTagged(tag = tag, inherit = True, latest = True):
+        for p in builds:
             if not p['tag_name'].startswith(self.tag):
                 continue
-            if p['name'] not in clang_gcc_br_pkgs.result():
+            if p['name'] not in clang_gcc_br_pkgs:
                 continue
 
-            pkgs[p['name']] = KojiPkg(p, 'https://koji.fedoraproject.org/koji/')
+            pkgs[p['name']] = KojiPkg(p['name'], p['nvr'], p['build_id'], p['tag_name'], KOJI_WEBURL)
         return pkgs
 
-    def get_file_prefix(self, is_baseline):
-        if not is_baseline:
-            return None
-        return self.tag
+class Sources:
+    def __init__(self):
+        self.sources = {}
+
+    # Return the results object for a Koji tag or Copr project, creating it
+    # only the first time it is asked for.
+    def get(self, cls, *args):
+        key = (cls,) + args
+        if key not in self.sources:
+            self.sources[key] = cls(*args)
+        return self.sources[key]
+
+    def koji(self, tag):
+        return self.get(KojiResults, tag)
 
-def remove_dist_tag(pkg):
-    return pkg.get_nvr_without_dist()
+    def copr(self, owner, project, url = u'https://copr.fedorainfracloud.org'):
+        return self.get(CoprResults, url, owner, project)
 
-def remove_epoch(pkg):
-    subject = Subject(pkg)
+KOJI_BUILD_STATES = {0 : 'BUILDING', 1 : 'COMPLETE', 2 : 'DELETED', 3 : 'FAILED', 4 : 'CANCELED'}
+
+def get_clang_koji_chunk(session, pkgs):
+    with metrics.phase('clang_koji_multicall') as p:
+        with session.multicall(strict = False) as m:
+            calls = [(pkg.name, m.listBuilds(pattern = get_nvr_up_to_dist(pkg) + '*',
+                                             queryOpts = {'order' : '-build_id', 'limit' : 1})) for pkg in pkgs]
+        p.items = len(calls)
+
+    builds = {}
+    for name, call in calls:
+        try:
+            result = call.result
+        except Exception as e:
+            print(name, str(e), file = sys.stderr)
+            continue
+        if result:
+            b = result[0]
+            builds[name] = {'build_id' : b['build_id'],
+                            'nvr' : b['nvr'],
+                            'state' : b['state'],
+                            'task_id' : b['task_id']}
+    return builds
+
+# Find the latest clang Koji build of the same version as each of the
+# given Fedora packages, whatever its state.  Packages without the tag's
+# dist tag are left out, the pattern would match other builds.  The lookups
+# are batched into multicalls of chunk_size packages that run concurrently.
+def get_clang_koji_builds(pkgs):
+    hub = config['clang_koji']['hub']
+    pkgs = [pkg for pkg in pkgs if isinstance(pkg, KojiPkg) and get_nvr_up_to_dist(pkg)]
+    chunk_size = config.getint('clang_koji', 'chunk_size')
+    # The chunks run at the same time, so each one needs its own session.
+    chunks = [executors['koji'].submit(get_clang_koji_chunk,
+                                       create_client('koji:' + hub, create_koji_session, hub),
+                                       pkgs[i:i + chunk_size])
+              for i in range(0, len(pkgs), chunk_size)]
+    builds = {}
+    for chunk in chunks:
+        builds.update(chunk.result())
+    return builds
+
+# Hash of everything that goes into a status page: this script, the output
+# settings, both package lists and the BuildRequires set, along with the
+# nav links, clang Koji builds, stale sources and ELN dependency graph.
+def get_fingerprint(baseline_pkgs, test_pkgs, clang_gcc_br_pkgs, clang_builds = None, stale = None):
+    h = hashlib.sha256()
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    h.update(json.dumps(sorted(config['output'].items())).encode())
+    # Every page links to all the others.
+    h.update(render_nav_links().encode())
+    for pkgs in [baseline_pkgs, test_pkgs]:
+        for name in sorted(pkgs):
+            p = pkgs[name]
+            h.update('{} {} {} {}\n'.format(name, p.nvr, p.build_id, p.build_passes).encode())
+        h.update(b'\0')
+    h.update('\n'.join(sorted(clang_gcc_br_pkgs)).encode())
+    if clang_builds:
+        h.update(json.dumps(clang_builds, sort_keys = True).encode())
+    if stale:
+        h.update(json.dumps(stale).encode())
+    if impact_graph:
+        h.update(impact_graph.digest.encode())
+    return h.hexdigest()
+
+def get_source_label(source):
+    if isinstance(source, KojiResults):
+        return source.tag
+    return source.get_source_name()
+
+# A status page, comparing the test builds against the baseline builds.
+class Comparison:
+    def __init__(self, name, title, baseline, test, copr_reporter = None):
+        self.name = name
+        self.title = title
+        self.baseline = baseline
+        self.test = test
+        self.copr_reporter = copr_reporter
+
+    # Decides which links the rows get.
+    def uses_copr(self):
+        return isinstance(self.test, CoprResults)
+
+    def __iter__(self):
+        return iter((self.baseline, self.test))
+
+# Sources are written as koji:TAG or copr:OWNER/PROJECT.
+def get_source(sources, spec):
+    kind, _, name = spec.partition(':')
+    if kind == 'koji':
+        return sources.koji(name)
+    if kind == 'copr':
+        owner, _, project = name.rpartition('/')
+        return sources.copr(owner, project)
+    raise ValueError('Unknown source {}'.format(spec))
+
+def get_page_names():
+    return config['comparisons']['pages'].split()
+
+# The comparisons to make, from the [comparison NAME] config section of
+# each page.  Sources used by several comparisons are only fetched once.
+def get_comparisons(sources):
+    comparisons = []
+    for name in get_page_names():
+        section = config['comparison ' + name]
+        comparisons.append(Comparison(name, section.get('title', name),
+                                      get_source(sources, section['baseline']),
+                                      get_source(sources, section['test']),
+                                      section.get('copr_reporter')))
+    return comparisons
+
+def split_nvr(nvr):
     try:
-        nevr = subject.get_nevra_possibilities(forms=hawkey.FORM_NEVR)[0]
-        return "{}-{}-{}".format(nevr.name, nevr.version, nevr.release)
-    except:
-        print("Cannot remove epoch for ", pkg, sys.stderr)
-        return pkg
+        name, version, release = nvr.rsplit('-', 2)
+    except ValueError:
+        print("Cannot parse NVR", nvr, file = sys.stderr)
+        return ('', nvr, '')
+    epoch, _, version = version.rpartition(':')
+    return (epoch, version, release)
+
+# A sort key that orders versions the same way as rpm's rpmvercmp(),
+# including the ~ and ^ rules, so that many comparisons can be made without
+# walking the segments each time.  Segments rank as ~, end of version, ^,
+# letters, numbers.
+@functools.lru_cache(maxsize = None)
+def version_key(version):
+    key = []
+    for x in re.findall('[0-9]+|[a-zA-Z]+|~|\\^', version):
+        if x == '~':
+            key.append((0,))
+        elif x == '^':
+            key.append((2,))
+        elif x.isdigit():
+            x = x.lstrip('0')
+            key.append((4, len(x), x))
+        else:
+            key.append((3, x))
+    key.append((1,))
+    return tuple(key)
+
+# Orders like rpm.labelCompare() on the version and release, the epoch is
+# ignored.
+def get_evr_key(evr):
+    return (version_key(evr[1]), version_key(evr[2]))
 
 def get_package_link(koji_url, pkg):
     return "{}/search?type=package&match=glob&terms={}".format(
@@ -128,29 +758,56 @@ def tag_to_dist_prefix(tag):
     # eln
     return basetag
 
-def get_build_link_with_different_dist(koji_url, pkg):
-    if 'copr' in pkg:
-        return pkg['copr'].get_build_link(pkg)
-    tag = pkg['tag_name']
-    nvr = pkg['nvr']
+# The NVR up to and including the dist tag of the package's tag, or None
+# if the release doesn't have that dist tag.
+def get_nvr_up_to_dist(pkg):
+    tag = pkg.tag_name
+    nvr = pkg.nvr
     #Remove everything after the dist-tag
     dist_prefix = tag_to_dist_prefix(tag)
-    dist_start = nvr.find(dist_prefix)
+    dist_start = nvr.rfind(dist_prefix, len(pkg.name))
+    if dist_start == -1:
+        return None
     dist_prefix_end = dist_start + len(dist_prefix)
-    search_str = nvr[0:dist_prefix_end]
-    return get_build_link(koji_url, pkg, search_str)
+    return nvr[0:dist_prefix_end]
+
+# Failed builds link to their task, which has the logs.
+def get_clang_koji_build_link(build):
+    if build['task_id']:
+        return '{}taskinfo?taskID={}'.format(CLANG_KOJI_WEBURL, build['task_id'])
+    return '{}buildinfo?buildID={}'.format(CLANG_KOJI_WEBURL, build['build_id'])
 
+def get_build_link_with_different_dist(koji_url, pkg):
+    if isinstance(pkg, CoprPkg):
+        return pkg.get_build_link(koji_url)
+    return get_build_link(koji_url, pkg, get_nvr_up_to_dist(pkg) or pkg.nvr)
+
+# Package records are created for every package in every tag, so they only
+# keep the fields the pages use and have no per-instance __dict__.
 class Pkg:
-    def __init__(self, name, nvr, build_passes = True):
+    __slots__ = ('name', 'nvr', 'build_id', 'build_passes', 'evr_key')
+
+    def __init__(self, name, nvr, build_id, build_passes = True):
         self.name = name
         self.nvr = nvr
+        self.build_id = build_id
         self.build_passes = build_passes
+        self.evr_key = None
+
+    # get_evr_key() of the NVR without the dist tag, worked out only once
+    # even though the record is shared by every page using its source.
+    def get_evr_key(self):
+        if not self.evr_key:
+            self.evr_key = get_evr_key(split_nvr(self.get_nvr_without_dist()))
+        return self.evr_key
 
 
 class KojiPkg(Pkg):
-    def __init__(self, pkg, koji_weburl):
-        super(KojiPkg, self).__init__(pkg['name'], pkg['nvr'])
-        self.pkg = pkg
+    __slots__ = ('tag_name', 'koji_weburl')
+
+    def __init__(self, name, nvr, build_id, tag_name, koji_weburl):
+        super(KojiPkg, self).__init__(name, nvr, build_id)
+        self.tag_name = tag_name
         self.koji_weburl = koji_weburl
 
     def get_nvr_without_dist(self):
@@ -158,8 +815,7 @@ class KojiPkg(Pkg):
 
     def get_build_link(self, search_str = None):
         if not search_str:
-            build = self.pkg['build_id']
-            return "{}/buildinfo?buildID={}".format(self.koji_weburl, build)
+            return "{}/buildinfo?buildID={}".format(self.koji_weburl, self.build_id)
         return "{}/search?type=build&match=regexp&terms={}".format(
                 self.koji_weburl, search_str)
     
@@ -172,10 +828,11 @@ class KojiPkg(Pkg):
 
 
 class CoprPkg(Pkg):
-    def __init__(self, pkg, copr_results, build_passes):
-        super(CoprPkg, self).__init__(pkg['name'], pkg['nvr'], build_passes)
-        self.pkg = pkg
-        self. copr_results = copr_results
+    __slots__ = ('copr_results',)
+
+    def __init__(self, name, nvr, build_id, copr_results, build_passes):
+        super(CoprPkg, self).__init__(name, nvr, build_id, build_passes)
+        self.copr_results = copr_results
     
     def get_nvr_without_dist(self):
         return self.nvr
@@ -184,13 +841,36 @@ class CoprPkg(Pkg):
         return self.copr_results.get_package_base_link()
     
     def get_build_link(self, koji_url, search_str = None):
-        return self.copr_results.get_build_link(self.pkg['id'])
+        return self.copr_results.get_build_link(self.build_id)
 
     def get_package_link(self):
         self.copr_results.get_package_link(self)
 
 
-# https://koji.fedoraproject.org/koji/
+KOJI_WEBURL = 'https://koji.fedoraproject.org/koji/'
+CLANG_KOJI_WEBURL = 'http://clang-koji-web.usersys.redhat.com/koji/'
+KOJI_PACKAGE_SEARCH = 'search?type=package&match=glob&terms='
+
+# Row templates, bound once instead of being rebuilt for every row.
+JENKINS_REBUILD_FORM = """<form target='_blank' class="form_cell" method='post' action='https://jenkins-llvm-upstream-ci.apps.ocp4.prod.psi.redhat.com/job/Koji%20Shadow%20Clang/build'>
+                            <input name='json' type='hidden' value="{{'parameter': [{{'name' : 'KOJI_NVR', 'value' : '{nvr}' }}, {{'name' : 'CI_MESSAGE', 'value' : ''}}], 'statusCode': '303', 'redirectTo': '/job/Koji%20Shadow%20Clang/'}}" />
+                           <input name='Rebuild' type='submit' value='Rebuild' />
+                         </form>""".format
+COPR_REBUILD_LINK = "<a target='_blank' href='{link}/rebuild'>Rebuild</a>".format
+NVR_LINK = "<a href='{link}'><span class='tooltip'>{clang_nvr}</span>{clang_nvr}</a>".format
+STATUS_LINK = "<a href='{link}'>{text}</a>".format
+HISTORY_LINK = "<a href='{history_url}'>[Build History]</a></td>".format
+HTML_ROW = """
+            <tr{row_style}>
+              <td class='pkg_cell'><a href='{fedora_build_url}'><span class='tooltip'>{nvr}</span>{nvr}</a></td>
+              <td>{column2}</td>
+              <td class='pkg_cell'>{column3}</td>
+              <td class='pkg_cell' style='max-width: 20ch;'>{column4}</td>
+              <td>{history}</td>
+              <td class='pkg_cell'><span class='tooltip'>{note}</span>{short_note}</td>
+              <td style='text-align: right;'>{impact}</td>
+            </tr>""".format
+
 class PkgCompare:
 
     STATUS_REGRESSION = 0
@@ -200,93 +880,57 @@ class PkgCompare:
     STATUS_FAILED = 4
     STATUS_PASS = 5
 
-    def __init__(self, pkg):
-        self.pkg = pkg
-        self.other_pkg = None
-        self.note = None
+    # Only used to render a row, the status is worked out by Classification.
+    __slots__ = ('pkg', 'other_pkg', 'other_pkg_status', 'up_to_date', 'package_base_link', 'note',
+                 'use_copr', 'clang_build', 'impact')
 
-    def add_other_pkg(self, pkg):
-        self.other_pkg = pkg
+    # use_copr is whether the test builds are in Copr rather than Koji.
+    def __init__(self, pkg, other_pkg, status, up_to_date, package_base_link, note = None, use_copr = True):
+        self.pkg = pkg
+        self.other_pkg = other_pkg
+        self.other_pkg_status = status
+        self.up_to_date = up_to_date
+        self.package_base_link = package_base_link
+        self.note = note
+        self.use_copr = use_copr
+        self.clang_build = None
+        self.impact = None
 
     def add_note(self, note):
         self.note = note
 
-    def compare_nvr(self, a_nvr, b_nvr):
-        subject_a = Subject(a_nvr)
-        subject_b = Subject(b_nvr)
-        nevra_a = subject_a.get_nevra_possibilities(forms=hawkey.FORM_NEVR)[0]
-        nevra_b = subject_b.get_nevra_possibilities(forms=hawkey.FORM_NEVR)[0]
-        return rpm.labelCompare(("", nevra_a.version, nevra_a.release), ("", nevra_b.version, nevra_b.release))
-
     def is_up_to_date(self):
-        if not self.other_pkg:
-            return False
-        if not self.other_pkg.build_passes:
-            return False
-        pkg_nvr = remove_epoch(remove_dist_tag(self.pkg))
-        other_nvr = remove_epoch(remove_dist_tag(self.other_pkg))
-
-        return self.compare_nvr(pkg_nvr, other_nvr) <= 0
-
-    def get_pkg_status(self):
-        if not self.pkg.build_passes:
-            return self.STATUS_FAILED
-        else:
-            return self.STATUS_PASS
+        return self.up_to_date
 
     def get_other_pkg_status(self):
-        if not self.other_pkg:
-            return self.STATUS_MISSING
-
-        if not self.other_pkg.build_passes:
-            if self.get_pkg_status() == self.STATUS_PASS:
-                return self.STATUS_REGRESSION
-            return self.STATUS_FAILED
+        return self.other_pkg_status
 
-        # other_pkg build passes
-        if not self.is_up_to_date():
-            return self.STATUS_OLD
-
-        # other pkg is up-to-date.
-        if self.get_pkg_status() == self.STATUS_FAILED:
-            return self.STATUS_FIXED
-
-        return self.STATUS_PASS
-
-
-    def html_row(self, index, pkg_notes = None):
-        row_style=''
+    # The contents of each column, shared by the static and virtual pages.
+    def get_row_cells(self):
         clang_nvr=''
         build_success = False
         has_note = False
 
-        if index % 2 == 0:
-            row_style=" class='even_row'"
         if self.other_pkg:
             clang_nvr = self.other_pkg.nvr
 
         column2 = ''
         if not self.is_up_to_date():
-            column2 = """<form target='_blank' class="form_cell" method='post' action='https://jenkins-llvm-upstream-ci.apps.ocp4.prod.psi.redhat.com/job/Koji%20Shadow%20Clang/build'>
-                            <input name='json' type='hidden' value="{{'parameter': [{{'name' : 'KOJI_NVR', 'value' : '{}' }}, {{'name' : 'CI_MESSAGE', 'value' : ''}}], 'statusCode': '303', 'redirectTo': '/job/Koji%20Shadow%20Clang/'}}" />
-                           <input name='Rebuild' type='submit' value='Rebuild' />
-                         </form>""".format(self.pkg.nvr)
-            if use_copr:
-                column2 = "<a target='_blank' href='{}/rebuild'>Rebuild</a>".format(self.package_base_link + self.pkg.name)
+            if self.use_copr:
+                column2 = COPR_REBUILD_LINK(link = self.package_base_link + self.pkg.name)
+            else:
+                column2 = JENKINS_REBUILD_FORM(nvr = self.pkg.nvr)
 
-        clang_latest_build_link = ''
-        clang_latest_build_text = ''
         column3 = ''
         column4 = ''
         status = self.get_other_pkg_status()
         if status == self.STATUS_FIXED or status == self.STATUS_PASS:
-            column3 = "<a href='{link}'><span class='tooltip'>{clang_nvr}</span>{clang_nvr}</a>".format(
-                    link = get_build_link('http://clang-koji-web.usersys.redhat.com/koji/', self.other_pkg),
-                    clang_nvr = clang_nvr)
+            column3 = NVR_LINK(link = get_build_link(CLANG_KOJI_WEBURL, self.other_pkg),
+                               clang_nvr = clang_nvr)
             column4 = "SAME"
             build_success = True
         else:
-            if use_copr:
+            if self.use_copr:
                 if status == self.STATUS_MISSING or status == self.STATUS_OLD:
                     url = self.package_base_link + self.pkg.name
                     text = 'MISSING'
@@ -294,55 +938,52 @@ class PkgCompare:
                     url = get_build_link('', self.other_pkg)
                     text = 'FAILED'
 
+            elif self.clang_build:
+                url = get_clang_koji_build_link(self.clang_build)
+                text = KOJI_BUILD_STATES.get(self.clang_build['state'], 'UNKNOWN')
             else:
-                url = get_build_link_with_different_dist('http://clang-koji-web.usersys.redhat.com/koji/', self.pkg)
+                url = get_build_link_with_different_dist(CLANG_KOJI_WEBURL, self.pkg)
                 text = 'MISSING OR FAILED'
-            column3 = "<a href='{link}'>{text}</a>".format(link=url, text=text)
+            column3 = STATUS_LINK(link = url, text = text)
 
             if status == self.STATUS_OLD:
-                column4 = "<a href='{link}'><span class='tooltip'>{clang_nvr}</span>{clang_nvr}</a>".format(
-                        link = get_build_link('http://clang-koji-web.usersys.redhat.com/koji/', self.other_pkg),
-                        clang_nvr = clang_nvr)
+                column4 = NVR_LINK(link = get_build_link(CLANG_KOJI_WEBURL, self.other_pkg),
+                                   clang_nvr = clang_nvr)
                 build_success = True
             else:
                 column4 = "NONE"
 
         note = ""
-        short_note = ""
         if self.note:
             has_note = True
             note = self.note
-            short_note = self.note
-
-        history_url='http://clang-koji-web.usersys.redhat.com/koji/search?type=package&match=glob&terms={}'.format(self.pkg.name)
-        if use_copr:
-            history_url = self.package_base_link + self.pkg.name
-        history="<a href='{history_url}'>[Build History]</a></td>".format(history_url=history_url)
-        if not use_copr and not self.other_pkg:
-           history=""
 
-        if not has_note and not build_success:
-            row_style=" class='todo_row'"
+        if self.use_copr:
+            history = HISTORY_LINK(history_url = self.package_base_link + self.pkg.name)
+        elif self.other_pkg:
+            history = HISTORY_LINK(history_url = CLANG_KOJI_WEBURL + KOJI_PACKAGE_SEARCH + self.pkg.name)
         else:
-            stats.num_pass_or_note += 1
-
-        return """
-            <tr{row_style}>
-              <td class='pkg_cell'><a href='{fedora_build_url}'><span class='tooltip'>{nvr}</span>{nvr}</a></td>
-              <td>{column2}</td>
-              <td class='pkg_cell'>{column3}</td>
-              <td class='pkg_cell' style='max-width: 20ch;'>{column4}</td>
-              <td>{history}</td>
-              <td class='pkg_cell'><span class='tooltip'>{note}</span>{short_note}</td>
-            </tr>""".format(row_style =row_style,
-                            fedora_build_url = get_build_link('https://koji.fedoraproject.org/koji/', self.pkg),
-                            nvr = self.pkg.nvr + (' (FAILED)' if use_copr and not self.pkg.build_passes else ''),
-                            column2 = column2,
-                            column3 = column3,
-                            column4 = column4,
-                            pkg_name = self.pkg.name,
-                            history = history,
-                            note = note, short_note = short_note)
+            history = ""
+
+        return {'todo' : not has_note and not build_success,
+                'fedora_build_url' : get_build_link(KOJI_WEBURL, self.pkg),
+                'nvr' : self.pkg.nvr + (' (FAILED)' if self.use_copr and not self.pkg.build_passes else ''),
+                'column2' : column2,
+                'column3' : column3,
+                'column4' : column4,
+                'history' : history,
+                'note' : note,
+                'impact' : '' if self.impact is None else self.impact}
+
+    def html_row(self, index, pkg_notes = None, cells = None):
+        if not cells:
+            cells = self.get_row_cells()
+        row_style=''
+        if cells['todo']:
+            row_style=" class='todo_row'"
+        elif index % 2 == 0:
+            row_style=" class='even_row'"
+        return HTML_ROW(row_style = row_style, short_note = cells['note'], **cells)
 
 class Stats:
     def __init__(self):
@@ -355,6 +996,9 @@ class Stats:
         self.num_fixed = 0
         self.num_missing = 0
 
+    def as_dict(self):
+        return dict(vars(self))
+
     def html_color_for_percent(percent):
         return 'black'
         if percent < 33.3:
@@ -396,6 +1040,73 @@ class Stats:
                     num_chars = num_chars)
 
 
+# Classifies every package of a comparison in one go.  Both package lists
+# are turned into columns sorted by name and joined in a single pass, which
+# gives a status column that the Stats are counted from.
+class Classification:
+    def __init__(self, baseline_pkgs, test_pkgs, notes = None):
+        self.names = sorted(baseline_pkgs)
+        self.baseline = [baseline_pkgs[name] for name in self.names]
+        self.notes = notes or {}
+        test_names = sorted(test_pkgs)
+        test = [test_pkgs[name] for name in test_names]
+
+        num_pkgs = len(self.names)
+        self.test = [None] * num_pkgs
+        self.statuses = array.array('b', [PkgCompare.STATUS_MISSING]) * num_pkgs
+        self.test_passes = array.array('b', [0]) * num_pkgs
+        self.up_to_date = array.array('b', [0]) * num_pkgs
+        self.num_failed_with_note = 0
+
+        j = 0
+        num_test = len(test_names)
+        for i, name in enumerate(self.names):
+            while j < num_test and test_names[j] < name:
+                j += 1
+            if j == num_test or test_names[j] != name:
+                continue
+
+            pkg = self.baseline[i]
+            test_pkg = test[j]
+            self.test[i] = test_pkg
+            if not test_pkg.build_passes:
+                if name in self.notes:
+                    self.num_failed_with_note += 1
+                if pkg.build_passes:
+                    self.statuses[i] = PkgCompare.STATUS_REGRESSION
+                else:
+                    self.statuses[i] = PkgCompare.STATUS_FAILED
+                continue
+
+            self.test_passes[i] = 1
+            if pkg.get_evr_key() > test_pkg.get_evr_key():
+                self.statuses[i] = PkgCompare.STATUS_OLD
+                continue
+
+            self.up_to_date[i] = 1
+            if not pkg.build_passes:
+                self.statuses[i] = PkgCompare.STATUS_FIXED
+            else:
+                self.statuses[i] = PkgCompare.STATUS_PASS
+
+    def get_stats(self):
+        stats = Stats()
+        stats.num_fedora_pkgs = len(self.names)
+        stats.num_clang_pkgs = self.test_passes.count(1)
+        stats.num_up_to_date_pkgs = self.up_to_date.count(1)
+        stats.num_regressions = self.statuses.count(PkgCompare.STATUS_REGRESSION)
+        stats.num_fixed = self.statuses.count(PkgCompare.STATUS_FIXED)
+        stats.num_missing = self.statuses.count(PkgCompare.STATUS_MISSING)
+        # A note on a failed build counts the same as a passing build.
+        stats.num_pass_or_note = stats.num_clang_pkgs + self.num_failed_with_note
+        return stats
+
+    def get_views(self, package_base_link, use_copr = True):
+        return [PkgCompare(pkg, test_pkg, status, bool(up_to_date), package_base_link, self.notes.get(pkg.name),
+                           use_copr)
+                for pkg, test_pkg, status, up_to_date in zip(self.baseline, self.test, self.statuses,
+                                                             self.up_to_date)]
+
 def get_html_header():
     return """
 <html>
@@ -445,6 +1156,12 @@ def get_html_header():
       .pkg_cell:hover .tooltip {
         visibility: visible;
       }
+      .stale {
+        color: #c9190b;
+      }
+      .trend_chart {
+        margin-right: 20px;
+      }
       .last_updated {
         font-size: 0.8em;
         margin-top: 20px;
@@ -460,47 +1177,922 @@ def get_html_header():
   <body class='redhat_font'>"""
 
 
-def get_gcc_clang_users_fedora():
+SNAPSHOT_VERSION = 1
+
+# Machine readable version of a status page.  Packages are stored as rows of
+# SNAPSHOT_COLUMNS to keep the file small.
+SNAPSHOT_COLUMNS = ['name', 'nvr', 'clang_nvr', 'status']
+
+def get_statuses():
+    statuses = {}
+    for name in dir(PkgCompare):
+        if name.startswith('STATUS_'):
+            statuses[name[len('STATUS_'):]] = getattr(PkgCompare, name)
+    return statuses
+
+def get_snapshot(file_prefix, stats, pkg_compare_list):
+    statuses = get_statuses()
+    return {'version' : SNAPSHOT_VERSION,
+            'tag' : file_prefix,
+            'generated' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'stats' : stats.as_dict(),
+            'statuses' : statuses,
+            'columns' : SNAPSHOT_COLUMNS,
+            'packages' : [[c.pkg.name,
+                           c.pkg.nvr,
+                           c.other_pkg.nvr if c.other_pkg else None,
+                           c.get_other_pkg_status()] for c in pkg_compare_list]}
+
+# What changed between two snapshots of the same page, as rows of
+# CHANGES_COLUMNS.  None means the package was not in that snapshot.
+CHANGES_VERSION = 1
+CHANGES_COLUMNS = ['name', 'old_nvr', 'nvr', 'old_clang_nvr', 'clang_nvr']
+
+def get_changes(old_snapshot, new_snapshot):
+    statuses = new_snapshot['statuses']
+    changes = {'from' : old_snapshot['generated'],
+               'to' : new_snapshot['generated'],
+               'regressed' : [],
+               'fixed' : [],
+               'missing' : [],
+               'updated' : [],
+               'removed' : []}
+
+    # Both package lists are sorted by name, so walk them together.  Old
+    # packages that are skipped over are no longer on the page.
+    old_pkgs = old_snapshot['packages']
+    i = 0
+    for name, nvr, clang_nvr, status in new_snapshot['packages']:
+        while i < len(old_pkgs) and old_pkgs[i][0] < name:
+            changes['removed'].append(get_removed_row(old_pkgs[i]))
+            i += 1
+        old_nvr, old_clang_nvr, old_status = None, None, None
+        if i < len(old_pkgs) and old_pkgs[i][0] == name:
+            old_nvr, old_clang_nvr, old_status = old_pkgs[i][1:]
+            i += 1
+
+        row = [name, old_nvr, nvr, old_clang_nvr, clang_nvr]
+        if status == statuses['REGRESSION'] and old_status != status:
+            changes['regressed'].append(row)
+        elif status in (statuses['PASS'], statuses['FIXED']) and \
+             old_status in (statuses['REGRESSION'], statuses['FAILED']):
+            changes['fixed'].append(row)
+        elif status == statuses['MISSING'] and old_status != status:
+            changes['missing'].append(row)
+        elif old_nvr is not None and (old_nvr != nvr or old_clang_nvr != clang_nvr):
+            changes['updated'].append(row)
+    for old_pkg in old_pkgs[i:]:
+        changes['removed'].append(get_removed_row(old_pkg))
+    return changes
+
+def get_removed_row(old_pkg):
+    name, old_nvr, old_clang_nvr, old_status = old_pkg
+    return [name, old_nvr, None, old_clang_nvr, None]
+
+def has_changes(changes):
+    return any(changes[key] for key in ['regressed', 'fixed', 'missing', 'updated', 'removed'])
+
+# Add the changes to <tag>-changes.json, which keeps the most recent ones,
+# newest first.
+def update_changes_feed(file_prefix, changes):
+    filename = '{}-changes.json'.format(file_prefix)
+    feed = read_json(filename)
+    if not feed or feed.get('version') != CHANGES_VERSION:
+        feed = {'version' : CHANGES_VERSION,
+                'tag' : file_prefix,
+                'columns' : CHANGES_COLUMNS,
+                'changes' : []}
+    feed['changes'] = [changes] + feed['changes'][:config.getint('changes', 'keep') - 1]
+    write_json(filename, feed)
+    write_file('{}-changes.html'.format(file_prefix), render_changes_page(file_prefix, feed))
+
+def render_changes_page(file_prefix, feed):
+    yield get_html_header()
+    yield """
+    <a href='{0}-status.html'>Back</a> (<a href='{0}-changes.json'>JSON</a>)""".format(file_prefix)
+    for changes in feed['changes']:
+        yield """
+        <h3>{} - {}</h3>""".format(changes['from'], changes['to'])
+        for key, title in [('regressed', 'Regressions'), ('fixed', 'Fixed'), ('missing', 'Missing'),
+                           ('updated', 'Updated'), ('removed', 'Removed')]:
+            # Older feeds don't have every group.
+            if not changes.get(key):
+                continue
+            yield """
+        <table>
+          <tr><th colspan='3'>{} ({})</th></tr>""".format(title, len(changes[key]))
+            for name, old_nvr, nvr, old_clang_nvr, clang_nvr in changes[key]:
+                yield """
+          <tr><td>{}</td><td>{} &rarr; {}</td><td>{} &rarr; {}</td></tr>""".format(
+                        name, old_nvr or '-', nvr or '-', old_clang_nvr or '-', clang_nvr or '-')
+            yield """
+        </table>"""
+    yield "</body></html>"
+
+# Stats of every run and the status changes of each package, kept in an
+# SQLite database so trends can be shown without asking Koji again.
+class History:
+    def __init__(self, filename):
+        self.filename = filename
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                            id INTEGER PRIMARY KEY, tag TEXT NOT NULL, time INTEGER NOT NULL, {})""".format(
+                       ', '.join('{} INTEGER NOT NULL'.format(c) for c in self.get_stats_columns())))
+            db.execute("CREATE INDEX IF NOT EXISTS runs_tag ON runs (tag, time)")
+            # The latest status of each package, to find what changed.
+            db.execute("""CREATE TABLE IF NOT EXISTS status (
+                            tag TEXT NOT NULL, package TEXT NOT NULL, status INTEGER NOT NULL,
+                            nvr TEXT, clang_nvr TEXT, PRIMARY KEY (tag, package)) WITHOUT ROWID""")
+            # status is NULL for packages that are not in the baseline.
+            db.execute("""CREATE TABLE IF NOT EXISTS transitions (
+                            tag TEXT NOT NULL, time INTEGER NOT NULL, package TEXT NOT NULL,
+                            old_status INTEGER, new_status INTEGER, nvr TEXT, clang_nvr TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS transitions_package ON transitions (package, time)")
+
+    def get_stats_columns(self):
+        return list(Stats().as_dict())
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout = 60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add_run(self, file_prefix, run_time, stats, pkg_compare_list):
+        columns = self.get_stats_columns()
+        stats = stats.as_dict()
+        packages = {c.pkg.name : (c.get_other_pkg_status(), c.pkg.nvr, c.other_pkg.nvr if c.other_pkg else None)
+                    for c in pkg_compare_list}
+
+        with self.connect() as db:
+            db.execute("INSERT INTO runs (tag, time, {}) VALUES (?, ?, {})".format(
+                           ', '.join(columns), ', '.join('?' * len(columns))),
+                       [file_prefix, run_time] + [stats[c] for c in columns])
+
+            old = {package : status for package, status in
+                   db.execute("SELECT package, status FROM status WHERE tag = ?", (file_prefix,))}
+            # There is nothing to compare the first run against.
+            if old:
+                transitions = []
+                for package, (status, nvr, clang_nvr) in packages.items():
+                    if old.get(package) != status:
+                        transitions.append((file_prefix, run_time, package, old.get(package), status, nvr, clang_nvr))
+                for package, status in old.items():
+                    if package not in packages:
+                        transitions.append((file_prefix, run_time, package, status, None, None, None))
+                db.executemany("INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?, ?)", transitions)
+
+            db.execute("DELETE FROM status WHERE tag = ?", (file_prefix,))
+            db.executemany("INSERT INTO status VALUES (?, ?, ?, ?, ?)",
+                           ((file_prefix, package) + row for package, row in packages.items()))
+
+            # Keep every run for a while, then only the last one of each day.
+            keep_all = run_time - config.getint('history', 'keep_all_days') * 86400
+            db.execute("""DELETE FROM runs WHERE time < ? AND id NOT IN (
+                            SELECT MAX(id) FROM runs GROUP BY tag, time / 86400)""", (keep_all,))
+
+    def get_runs(self, file_prefix, since):
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in
+                    db.execute("SELECT * FROM runs WHERE tag = ? AND time >= ? ORDER BY time", (file_prefix, since))]
+
+    def get_transitions(self, package):
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in
+                    db.execute("SELECT * FROM transitions WHERE package = ? ORDER BY time", (package,))]
+
+TREND_CHART = """
+        <svg class='trend_chart' width='{width}' height='{height}'>
+          <text x='0' y='12' font-size='12'>{title}</text>
+          <text x='0' y='{bottom}' font-size='10' dy='12'>{start}</text>
+          <text x='{width}' y='{bottom}' font-size='10' dy='12' text-anchor='end'>{end}</text>
+          <line x1='0' y1='{bottom}' x2='{width}' y2='{bottom}' stroke='#999999' />{lines}
+        </svg>"""
+
+TREND_COLORS = ['#0066cc', '#3e8635', '#c9190b', '#f0ab00']
+
+def render_trend_chart(title, runs, series, max_value = None, width = 320, height = 120):
+    top = 18
+    bottom = height - 14
+    times = [r['time'] for r in runs]
+    time_range = max(times[-1] - times[0], 1)
+    if max_value is None:
+        max_value = max([max(values) for label, values in series] + [1])
+
+    lines = ''
+    for index, (label, values) in enumerate(series):
+        color = TREND_COLORS[index % len(TREND_COLORS)]
+        points = ' '.join('{:.1f},{:.1f}'.format(width * (t - times[0]) / time_range,
+                                                  bottom - (bottom - top) * v / max_value)
+                          for t, v in zip(times, values))
+        lines += """
+          <polyline points='{}' fill='none' stroke='{}' />
+          <text x='{}' y='12' font-size='10' fill='{}' text-anchor='end'>{} {:g}</text>""".format(
+                  points, color, width - 90 * (len(series) - 1 - index), color, label, round(values[-1], 1))
+
+    return TREND_CHART.format(width = width, height = height, bottom = bottom, title = title, lines = lines,
+                              start = datetime.datetime.utcfromtimestamp(times[0]).strftime('%Y-%m-%d'),
+                              end = datetime.datetime.utcfromtimestamp(times[-1]).strftime('%Y-%m-%d'))
+
+def render_trend_charts(file_prefix):
+    since = time.time() - config.getint('history', 'chart_days') * 86400
+    runs = history.get_runs(file_prefix, since)
+    if len(runs) < 2:
+        return ''
+
+    def percent(key):
+        return [100 * r[key] / max(r['num_fedora_pkgs'], 1) for r in runs]
+
+    return (render_trend_chart('Clang Builds (%)', runs, [('Builds', percent('num_clang_pkgs')),
+                                                          ('Latest', percent('num_up_to_date_pkgs'))], 100) +
+            render_trend_chart('Packages', runs, [('Regressions', [r['num_regressions'] for r in runs]),
+                                                  ('Missing', [r['num_missing'] for r in runs])]))
+
+# Print the status changes of a package, e.g. to find when it regressed.
+def print_package_history(package):
+    if not history:
+        print('History is disabled in the config', file = sys.stderr)
+        return
+    names = {code : name for name, code in get_statuses().items()}
+    for t in history.get_transitions(package):
+        print('{} {:<20} {:>10} -> {:<10} {} {}'.format(
+                datetime.datetime.utcfromtimestamp(t['time']).strftime("%Y-%m-%dT%H:%M:%SZ"), t['tag'],
+                names.get(t['old_status'], '-'), names.get(t['new_status'], '-'),
+                t['nvr'] or '', t['clang_nvr'] or ''))
+
+def render_failed_page(file_prefix):
+    yield get_html_header()
+    yield 'Failed to load package lists'
+    yield """
+          <form style="display: inline;" action="update.py">
+            <input type="hidden" name="tag" value="{}" />
+            <input type="submit" value="Update">
+          </form>""".format(file_prefix)
+    yield "</body></html>"
+
+def render_nav_links():
+    links = ''
+    for name in get_page_names():
+        section = config['comparison ' + name]
+        links += """
+    <a href='{}-status.html'>{}</a>""".format(name, section.get('title', name))
+        if section.get('copr_reporter'):
+            links += "(<a href='copr-reporter-{}.html'>Detailed</a>)".format(section['copr_reporter'])
+    return links
+
+INDEX_PAGE = """<html>
+  <head>
+  </head>
+  <body>
+    <h2> Clang Build Status </h2>{}
+    <form action="update.py"><input type="submit" value="Update">
+  </body>
+</html>
+"""
+
+def write_index_page():
+    write_file('index.html', [INDEX_PAGE.format(render_nav_links())])
+
+# stale lists the sources whose package lists could not be fetched, with
+# the time of the saved lists used instead.
+def render_page_top(file_prefix, stats, stale = ()):
+    yield get_html_header()
+    yield render_nav_links() + """
+    """
+    for label, saved in stale:
+        yield """
+    <div class='stale'>Could not fetch {}, showing its packages from {}</div>""".format(
+                label, time.strftime('%m/%d/%Y %H:%M:%S UTC', time.gmtime(saved)))
+    yield stats.html_table()
+    if history:
+        yield render_trend_charts(file_prefix)
+    yield """
+        <form style="display: inline;" action="update.py">
+          <input type="hidden" name="tag" value="{0}" />
+          <input type="submit" value="Update">
+        </form>""".format(file_prefix)
+    # The feed is only written once something changes.
+    if os.path.exists('{}-changes.html'.format(file_prefix)):
+        yield """
+        <a href='{0}-changes.html'>Recent Changes</a>""".format(file_prefix)
+    yield """
+          <div class="last_updated">Last Updated: <div id='timestamp' style="display: inline-block;">{0}</div></div>
+            <script>
+              var date = new Date(document.getElementById("timestamp").innerHTML);
+              document.getElementById("timestamp").innerHTML = date.toString();
+            </script>""".format(datetime.datetime.utcnow().strftime("%m/%d/%Y %H:%M:%S UTC"))
+
+TABLE_HEADER = """
+        <table>
+          <tr><th colspan='2'>Fedora</th><th colspan='4'>Fedora Clang</th><th></th></tr>
+          <tr><th colspan='2'>Latest Build</th><th>Latest Build</th><th>Latest Success</th><th></th><th>Notes</th><th>Impact</th>"""
+
+def render_page(file_prefix, stats, pkg_compare_list, stale = ()):
+    yield from render_page_top(file_prefix, stats, stale)
+    yield TABLE_HEADER
+    for index, c in enumerate(pkg_compare_list):
+        yield c.html_row(index)
+    yield "</table></body></html>"
+
+# The columns of the rows file used by the virtual page, status followed by
+# the get_row_cells() keys.
+ROWS_COLUMNS = ['status', 'todo', 'fedora_build_url', 'nvr', 'column2', 'column3', 'column4', 'history', 'note',
+                'impact']
+
+def get_rows_data(pkg_compare_list):
+    rows = []
+    for c in pkg_compare_list:
+        cells = c.get_row_cells()
+        cells['status'] = c.get_other_pkg_status()
+        rows.append([cells[k] for k in ROWS_COLUMNS])
+    return {'columns' : ROWS_COLUMNS, 'rows' : rows}
+
+# Renders only the rows that are scrolled into view.  Every row has the
+# same height, so the rows above and below the visible ones are replaced by
+# a single spacer row each.
+VIRTUAL_TABLE_SCRIPT = """
+    <script>
+      var ROW_HEIGHT = 24;
+      var rows = [];
+      var visible = [];
+
+      function row_html(row, index) {
+        var style = row[1] ? " class='todo_row'" : (index % 2 == 0 ? " class='even_row'" : "");
+        return "<tr" + style + ">" +
+               "<td class='pkg_cell'><a href='" + row[2] + "'><span class='tooltip'>" + row[3] + "</span>" + row[3] + "</a></td>" +
+               "<td>" + row[4] + "</td>" +
+               "<td class='pkg_cell'>" + row[5] + "</td>" +
+               "<td class='pkg_cell' style='max-width: 20ch;'>" + row[6] + "</td>" +
+               "<td>" + row[7] + "</td>" +
+               "<td class='pkg_cell'><span class='tooltip'>" + row[8] + "</span>" + row[8] + "</td>" +
+               "<td style='text-align: right;'>" + row[9] + "</td></tr>";
+      }
+
+      function render_rows() {
+        var container = document.getElementById('rows_container');
+        var first = Math.max(0, Math.floor(container.scrollTop / ROW_HEIGHT) - 20);
+        var last = Math.min(visible.length, first + Math.ceil(container.clientHeight / ROW_HEIGHT) + 40);
+        var html = ["<tr style='height: " + (first * ROW_HEIGHT) + "px;'></tr>"];
+        for (var i = first; i < last; i++) {
+          html.push(row_html(visible[i], i));
+        }
+        html.push("<tr style='height: " + ((visible.length - last) * ROW_HEIGHT) + "px;'></tr>");
+        document.getElementById('rows').innerHTML = html.join('');
+      }
+
+      function filter_rows() {
+        var statuses = {};
+        document.querySelectorAll('.status_filter').forEach(function(box) {
+          statuses[box.value] = box.checked;
+        });
+        visible = rows.filter(function(row) { return statuses[row[0]]; });
+        document.getElementById('num_visible').innerHTML = visible.length;
+        render_rows();
+      }
+
+      document.getElementById('rows_container').addEventListener('scroll', render_rows);
+      document.querySelectorAll('.status_filter').forEach(function(box) {
+        box.addEventListener('change', filter_rows);
+      });
+
+      fetch(ROWS_URL).then(function(response) {
+        return new Response(response.body.pipeThrough(new DecompressionStream('gzip'))).json();
+      }).then(function(data) {
+        rows = data.rows;
+        filter_rows();
+      });
+    </script>"""
+
+def render_virtual_page(file_prefix, stats, stale = ()):
+    yield from render_page_top(file_prefix, stats, stale)
+    yield """
+        <style>
+          #rows_container {
+            height: 80vh;
+            overflow-y: auto;
+          }
+          #rows_container tr {
+            height: 24px;
+          }
+        </style>
+        <div>"""
+    for name in ['REGRESSION', 'MISSING', 'OLD', 'FIXED', 'FAILED', 'PASS']:
+        yield """
+          <label><input type='checkbox' class='status_filter' value='{}' checked />{}</label>""".format(
+                getattr(PkgCompare, 'STATUS_' + name), name)
+    yield """
+          (<span id='num_visible'>0</span> shown)
+        </div>
+        <div id='rows_container'>"""
+    yield TABLE_HEADER
+    yield """
+          <tbody id='rows'></tbody>
+        </table>
+        </div>
+        <script>var ROWS_URL = '{}-rows.json.gz';</script>""".format(file_prefix)
+    yield VIRTUAL_TABLE_SCRIPT
+    yield "</body></html>"
+
+# Packages are sharded by the start of their name, so a package stays in
+# the same shard from run to run.
+def get_shard_key(name):
+    prefix = name[:config.getint('output', 'shard_prefix_length')].lower()
+    return re.sub('[^a-z0-9]', '_', prefix)
+
+def get_shard_dir(file_prefix):
+    return '{}-shards'.format(file_prefix)
+
+SHARD_SCRIPT = """
+    <script>
+      document.querySelectorAll('details.shard').forEach(function(shard) {
+        shard.addEventListener('toggle', function() {
+          if (!shard.open || shard.loaded) {
+            return;
+          }
+          shard.loaded = true;
+          fetch(SHARD_DIR + '/' + shard.dataset.shard + '.html').then(function(response) {
+            return response.text();
+          }).then(function(rows) {
+            shard.querySelector('tbody').innerHTML = rows;
+          });
+        });
+      });
+    </script>"""
+
+# shards is a list of (key, number of packages, number to do).
+def render_sharded_page(file_prefix, stats, shards, stale = ()):
+    yield from render_page_top(file_prefix, stats, stale)
+    for key, num_pkgs, num_todo in shards:
+        yield """
+        <details class='shard' data-shard='{key}'>
+          <summary>{key} ({} packages, {} to do)</summary>{}
+          <tbody></tbody>
+        </table>
+        </details>""".format(num_pkgs, num_todo, TABLE_HEADER, key = key)
+    yield """
+    <script>var SHARD_DIR = '{}';</script>""".format(get_shard_dir(file_prefix))
+    yield SHARD_SCRIPT
+    yield "</body></html>"
+
+# Each shard holds only the table rows for its packages.  Rows are numbered
+# within their shard, so other shards don't change when a package is added.
+def write_sharded_page(file_prefix, stats, pkg_compare_list, stale = ()):
+    shards = {}
+    for c in pkg_compare_list:
+        shards.setdefault(get_shard_key(c.pkg.name), []).append(c)
+    shards = sorted(shards.items())
+
+    shard_dir = get_shard_dir(file_prefix)
+    os.makedirs(shard_dir, exist_ok = True)
+    summary = []
+    written = 0
+    for key, shard in shards:
+        rows = []
+        num_todo = 0
+        for index, c in enumerate(shard):
+            cells = c.get_row_cells()
+            num_todo += cells['todo']
+            rows.append(c.html_row(index, cells = cells))
+        if write_precompressed(os.path.join(shard_dir, '{}.html'.format(key)), ''.join(rows).encode()):
+            written += 1
+        summary.append((key, len(shard), num_todo))
+    metrics.add('shards_written', file_prefix, items = written)
+
+    # Remove the shards of prefixes that no package has any more.
+    keys = set(key for key, shard in shards)
+    for filename in os.listdir(shard_dir):
+        if filename.split('.')[0] not in keys:
+            os.unlink(os.path.join(shard_dir, filename))
+
+    page = ''.join(render_sharded_page(file_prefix, stats, summary, stale))
+    write_precompressed('{}-status.html'.format(file_prefix), page.encode())
+
+# The files that only some output modes write, which are removed when
+# another mode is used so that they aren't published along with its page.
+MODE_FILES = {'virtual' : ['{}-rows.json.gz'],
+              'sharded' : ['{}-status.html.gz', '{}-status.html.br']}
+
+def remove_other_mode_files(file_prefix, mode):
+    for other_mode, filenames in MODE_FILES.items():
+        if other_mode == mode:
+            continue
+        for filename in filenames:
+            if os.path.exists(filename.format(file_prefix)):
+                os.unlink(filename.format(file_prefix))
+    if mode != 'sharded' and os.path.isdir(get_shard_dir(file_prefix)):
+        shutil.rmtree(get_shard_dir(file_prefix))
+
+def write_status_page(file_prefix, stats, pkg_compare_list, stale = ()):
+    filename = '{}-status.html'.format(file_prefix)
+    remove_other_mode_files(file_prefix, config['output']['mode'])
+    if config['output']['mode'] == 'sharded':
+        write_sharded_page(file_prefix, stats, pkg_compare_list, stale)
+        return
+    # The snapshot and the history always go by name, only the page is
+    # reordered.
+    if config['output']['sort'] == 'impact':
+        pkg_compare_list = sorted(pkg_compare_list, key = lambda c : -(c.impact or 0))
+    if config['output']['mode'] != 'virtual':
+        write_file(filename, render_page(file_prefix, stats, pkg_compare_list, stale))
+        return
+
+    # Write the rows before the page that loads them.
+    rows = json.dumps(get_rows_data(pkg_compare_list), separators = (',', ':'))
+    write_file('{}-rows.json.gz'.format(file_prefix), [gzip.compress(rows.encode(), mtime = 0)], 'wb')
+    write_file(filename, render_virtual_page(file_prefix, stats, stale))
+
+ELN_COMPOSES = ['BaseOS', 'AppStream', 'CRB', 'Extras']
+ELN_SOURCE_URL = 'https://odcs.fedoraproject.org/composes/production/latest-Fedora-ELN/compose/{}/source/tree/'
+ELN_BINARY_URL = 'https://odcs.fedoraproject.org/composes/production/latest-Fedora-ELN/compose/{}/x86_64/os/'
+
+# The JSON form of an ImpactGraph, from (package id, dependent id) pairs.
+def get_impact_graph_data(names, edges):
+    offsets = [0] * (len(names) + 1)
+    for source, dependent in edges:
+        offsets[source + 1] += 1
+    for i in range(len(names)):
+        offsets[i + 1] += offsets[i]
+    return {'names' : names,
+            'offsets' : offsets,
+            'targets' : [dependent for source, dependent in sorted(edges)]}
+
+# Reverse BuildRequires between the ELN source packages, with packages
+# numbered by their position in names.  The packages that build require
+# package i are targets[offsets[i]:offsets[i + 1]].
+class ImpactGraph:
+    def __init__(self, names, offsets, targets):
+        self.names = names
+        self.ids = {name : i for i, name in enumerate(names)}
+        self.offsets = array.array('l', offsets)
+        self.targets = array.array('l', targets)
+        self.digest = hashlib.sha256(self.offsets.tobytes() + self.targets.tobytes()).hexdigest()
+
+    # Count the packages that can't be built while each of the given
+    # packages is broken, directly or through other packages.  A single
+    # walk of the graph from all of them finds the strongly connected
+    # components (Tarjan), and each component's reachable set is built as a
+    # bitmask from those of the components below it, which are always
+    # finished first.
+    def get_impact(self, pkgs):
+        offsets = self.offsets
+        targets = self.targets
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        reach = {}
+
+        for root in [self.ids[name] for name in pkgs if name in self.ids]:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, offsets[root])]
+            while work:
+                node, i = work[-1]
+                if i < offsets[node + 1]:
+                    work[-1] = (node, i + 1)
+                    child = targets[i]
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, offsets[child]))
+                    elif child in on_stack:
+                        low[node] = min(low[node], index[child])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    members.append(member)
+                    if member == node:
+                        break
+                bits = 0
+                for member in members:
+                    bits |= 1 << member
+                    for child in targets[offsets[member]:offsets[member + 1]]:
+                        bits |= reach.get(child, 0)
+                for member in members:
+                    reach[member] = bits
+
+        return {name : bin(reach[self.ids[name]]).count('1') - 1 for name in pkgs if name in self.ids}
+
+def read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Write the chunks to a temporary file and rename it into place, so readers
+# never see a half-written file even if the run dies part way through.
+def write_file(filename, chunks, mode = 'w', buffer_size = 256):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+    tmp = '{}.tmp.{}'.format(filename, os.getpid())
+    empty = b'' if 'b' in mode else ''
+    try:
+        with open(tmp, mode) as f:
+            buf = []
+            for chunk in chunks:
+                buf.append(chunk)
+                if len(buf) == buffer_size:
+                    f.write(empty.join(buf))
+                    buf = []
+            f.write(empty.join(buf))
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def write_json(filename, data):
+    write_file(filename, [json.dumps(data, separators = (',', ':'))])
+
+# brotli is optional, without it only the .gz files are written.
+def get_brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+# Write data along with .gz and .br compressed copies for servers that can
+# send those directly.  Nothing is written if the file already has the same
+# contents.  Returns whether the file was written.
+def write_precompressed(filename, data):
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+
+    write_file(filename + '.gz', [gzip.compress(data, mtime = 0)], 'wb')
+    brotli = get_brotli()
+    if brotli:
+        write_file(filename + '.br', [brotli.compress(data)], 'wb')
+    write_file(filename, [data], 'wb')
+    return True
+
+def get_repomd_checksum(baseurl):
+    import urllib.request
+    with urllib.request.urlopen(baseurl + 'repodata/repomd.xml', timeout = config.getint('fetch', 'timeout')) as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# The ELN source packages that build require each ELN source package,
+# found by going through the binary packages that provide each
+# BuildRequires.  Returns the package names and the dependencies as
+# (package id, dependent package id) pairs.  Rich dependencies and file
+# dependencies are left out.
+def get_reverse_dependencies(sources, binaries):
+    provided_by = {}
+    for pkg in binaries:
+        source = pkg.sourcerpm.rsplit('-', 2)[0]
+        for provide in pkg.provides:
+            provided_by.setdefault(str(provide).split()[0], set()).add(source)
+
+    names = sorted(set(pkg.name for pkg in sources))
+    ids = {name : i for i, name in enumerate(names)}
+    edges = set()
+    for pkg in sources:
+        for require in pkg.requires:
+            require = str(require)
+            if require.startswith('('):
+                continue
+            for source in provided_by.get(require.split()[0], ()):
+                if source != pkg.name and source in ids:
+                    edges.add((ids[source], ids[pkg.name]))
+    return names, edges
+
+def load_eln_data():
+    import dnf
+
     # Repo setup
     base = dnf.Base()
     conf = base.conf
-    for compose in ['BaseOS', 'AppStream', 'CRB', 'Extras']:
-        base.repos.add_new_repo(f'eln-{compose}-source', conf, baseurl=[f'https://odcs.fedoraproject.org/composes/production/latest-Fedora-ELN/compose/{compose}/source/tree/'])
+    # Keep the downloaded repodata and solv files between runs.  This is
+    # only called once a repomd.xml has changed, so don't let dnf use its
+    # cached copy of the old one.
+    conf.cachedir = os.path.join(cache_dir, 'dnf')
+    for compose in ELN_COMPOSES:
+        base.repos.add_new_repo(f'eln-{compose}-source', conf, baseurl=[ELN_SOURCE_URL.format(compose)],
+                                metadata_expire=0)
+        if config.getboolean('eln', 'impact'):
+            base.repos.add_new_repo(f'eln-{compose}-binary', conf, baseurl=[ELN_BINARY_URL.format(compose)],
+                                    metadata_expire=0)
     repos = base.repos.get_matching('*')
     repos.disable()
-    repos = base.repos.get_matching('eln-*-source')
+    repos = base.repos.get_matching('eln-*')
     repos.enable()
 
     # Find all the relevant packages
     base.fill_sack()
-    q = base.sack.query()
-    q = q.available()
-    q = q.filter(requires=['gcc', 'gcc-c++', 'clang'])
-    return set([p.name for p in list(q)])
-
-def update_status(mutex):
-    while not mutex.locked():
-        time.sleep(10)
-        print("Processing...")
-        sys.stdout.flush()
+    sources = base.sack.query().available().filter(arch = 'src')
+    q = sources.filter(requires=['gcc', 'gcc-c++', 'clang'])
+    data = {'pkgs' : sorted(set([p.name for p in list(q)])),
+            'graph' : None}
+    if config.getboolean('eln', 'impact'):
+        binaries = base.sack.query().available().filter(arch__neq = 'src')
+        names, edges = get_reverse_dependencies(list(sources), list(binaries))
+        data['graph'] = get_impact_graph_data(names, edges)
+    return data
+
+def get_repomd_key():
+    urls = {compose : ELN_SOURCE_URL.format(compose) for compose in ELN_COMPOSES}
+    if config.getboolean('eln', 'impact'):
+        for compose in ELN_COMPOSES:
+            urls[compose + '-binary'] = ELN_BINARY_URL.format(compose)
+    return {name : record('eln', 'repomd', lambda url : call_with_retry(get_host(url), get_repomd_checksum, url), url)
+            for name, url in urls.items()}
+
+def set_impact_graph(data):
+    global impact_graph
+    impact_graph = ImpactGraph(**data) if data else None
 
-cgitb.enable()
-
-# Return something right away so the server doesn't timeout.
-print("Content-Type: text/html")
-print("")
-print("<!DOCTYPE HTML><html><head>")
-sys.stdout.flush()
-
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
-
-# Run a thread to periodically write to stdout to avoid the web server
-# timing out.  There's probably a way to increase the web server timeout
-# but I could not figure it out.
-status_mutex = threading.Lock()
-executor.submit(update_status, status_mutex)
+def get_gcc_clang_users_fedora():
+    start = time.time()
+    cache_file = os.path.join(cache_dir, 'eln-buildrequires.json')
 
-clang_gcc_br_pkgs_fedora = executor.submit(get_gcc_clang_users_fedora)
+    # The package set only changes when one of the ELN repos changes, so use
+    # the repomd.xml checksums as the cache key.
+    try:
+        with metrics.phase('eln_repomd') as m:
+            key = get_repomd_key()
+            m.items = len(key)
+    except Exception as e:
+        print('Cannot fetch ELN repomd.xml:', str(e), file = sys.stderr)
+        key = None
+
+    cached = read_json(cache_file)
+    if key and cached and cached['key'] == key:
+        print('ELN BuildRequires cache hit, saved {:.1f}s'.format(
+              cached['elapsed'] - (time.time() - start)), file = sys.stderr)
+        metrics.add('eln_cache_hit', '', items = len(cached['pkgs']))
+        set_impact_graph(cached.get('graph'))
+        return set(cached['pkgs'])
+
+    print('ELN BuildRequires cache miss', file = sys.stderr)
+    try:
+        with metrics.phase('eln_fill_sack') as m:
+            data = record('eln', 'eln_data', load_eln_data)
+            m.items = len(data['pkgs'])
+    except Exception as e:
+        # An old package set is better than none at all.
+        if not cached:
+            raise
+        print('Cannot load ELN repos, using the last BuildRequires set:', str(e), file = sys.stderr)
+        set_impact_graph(cached.get('graph'))
+        return set(cached['pkgs'])
+    if key:
+        write_json(cache_file, {'key' : key,
+                                'elapsed' : time.time() - start,
+                                'pkgs' : data['pkgs'],
+                                'graph' : data['graph']})
+    set_impact_graph(data['graph'])
+    return set(data['pkgs'])
+
+COPR_REPORTER_DIR = 'copr-reporter'
+
+# Runs on the jobs pool, so it only returns the new fingerprint of the
+# report, if it was written, for the caller to store.
+def run_copr_reporter(page, comparison, old_fingerprint):
+    output = os.path.abspath('copr-reporter-{}.html'.format(page))
+    src = os.path.abspath(COPR_REPORTER_DIR)
+    ini = '{}.ini'.format(page)
+
+    # The report only depends on the reporter itself and the full Copr
+    # listings of the comparison it details, including the packages and
+    # builds that aren't on the status page.  Without those listings, say
+    # when a source fell back to its saved package list, always run it.
+    for source in comparison:
+        source.packages.result()
+    digests = [source.listing_digest for source in comparison]
+    fingerprint = None
+    if None not in digests:
+        h = hashlib.sha256()
+        for f in ['json_generator.py', 'html_generator.py', ini]:
+            with open(os.path.join(src, f), 'rb') as fh:
+                h.update(fh.read())
+        for digest in digests:
+            h.update(digest.encode())
+        fingerprint = h.hexdigest()
+    if fingerprint and old_fingerprint == fingerprint and os.path.exists(output):
+        print("COPR REPORTER", page, "unchanged", file = sys.stderr)
+        return None
+
+    # Each page gets its own copy of copr-reporter to run in, since the
+    # generators write their output to the current directory.
+    print("COPR REPORTER", page, file = sys.stderr)
+    workdir = os.path.join(cache_dir, 'copr-reporter', page)
+    shutil.copytree(src, workdir, dirs_exist_ok = True)
+    try:
+        with metrics.phase('copr_reporter', page):
+            for cmd in [[sys.executable, './json_generator.py', ini],
+                        [sys.executable, './html_generator.py']]:
+                subprocess.run(cmd, cwd = workdir, stdout = sys.stderr, check = True)
+        tmp = '{}.tmp.{}'.format(output, os.getpid())
+        shutil.copyfile(os.path.join(workdir, 'report.html'), tmp)
+        os.replace(tmp, output)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("COPR REPORTER", page, str(e), file = sys.stderr)
+        return None
+    return fingerprint
+
+DEFAULT_CONFIG = {'cache' : {'dir' : '.cache'},
+                  # snapshot_max_age is in hours.
+                  'koji' : {'snapshot_max_age' : '24',
+                            'max_changes' : '1000'},
+                  'copr' : {'page_size' : '1000'},
+                  # 'static' writes every row into the page, 'virtual'
+                  # writes a small page that loads <tag>-rows.json.gz.
+                  # 'sharded' writes the rows into one file per name prefix
+                  # in <tag>-shards/, only rewriting the ones that changed,
+                  # along with .gz and .br copies.
+                  # sort is 'name', or 'impact' to list the packages that
+                  # block the most ELN packages first.  Sharded pages are
+                  # always sorted by name.
+                  'output' : {'mode' : 'static',
+                              'shard_prefix_length' : '1',
+                              'sort' : 'name'},
+                  # file is relative to the cache directory.  Set
+                  # prometheus to also write a node_exporter textfile.
+                  'metrics' : {'file' : 'metrics.json',
+                               'prometheus' : ''},
+                  'concurrency' : {'koji' : '4',
+                                   'copr' : '4'},
+                  # Set mode to 'record' to save every Koji, Copr and dnf
+                  # result to file, or to 'replay' to run from that file
+                  # without network access.
+                  'replay' : {'mode' : '',
+                              'file' : 'fixtures.json'},
+                  # Set hub to the clang Koji hub URL to look up the build
+                  # state of failed and missing packages for the rows.
+                  # Only used when the test builds are not in Copr.
+                  'clang_koji' : {'hub' : '',
+                                  'chunk_size' : '500'},
+                  # Number of runs kept in each <tag>-changes.json.
+                  'changes' : {'keep' : '100'},
+                  # file is relative to the cache directory, leave it empty
+                  # to not keep any history.  Runs older than keep_all_days
+                  # are thinned out to one per day.
+                  'history' : {'file' : 'history.sqlite',
+                               'keep_all_days' : '30',
+                               'chart_days' : '90'},
+                  # The pages to generate.  Each one needs a [comparison NAME]
+                  # section with the baseline and test sources, as
+                  # koji:TAG or copr:OWNER/PROJECT.  copr_reporter names the
+                  # copr-reporter page with the details of a comparison.
+                  'comparisons' : {'pages' : 'f35 f36 clang-built-f36'},
+                  'comparison f35' : {'title' : 'Fedora 35',
+                                      'baseline' : 'koji:f35',
+                                      'test' : 'copr:@fedora-llvm-team/clang-built-f35'},
+                  'comparison f36' : {'title' : 'Fedora 36',
+                                      'baseline' : 'koji:f36',
+                                      'test' : 'copr:@fedora-llvm-team/clang-built-f36'},
+                  'comparison clang-built-f36' : {'title' : 'Clang f35 vs f36',
+                                                  'baseline' : 'copr:@fedora-llvm-team/clang-built-f35',
+                                                  'test' : 'copr:@fedora-llvm-team/clang-built-f36',
+                                                  'copr_reporter' : 'f36'},
+                  # timeout is in seconds.  After breaker_failures failed
+                  # calls in a row, a server isn't called again for
+                  # breaker_reset seconds.
+                  'fetch' : {'timeout' : '120',
+                             'retries' : '3',
+                             'backoff' : '2',
+                             'max_backoff' : '60',
+                             'breaker_failures' : '5',
+                             'breaker_reset' : '300'},
+                  # A page requested through update.py within fresh_seconds
+                  # of its last check is not checked again.  Jobs that
+                  # haven't finished after job_timeout seconds are given up
+                  # on.
+                  'cgi' : {'fresh_seconds' : '60',
+                           'job_timeout' : '3600'},
+                  # Set impact to also load the x86_64 ELN repos and count
+                  # how many ELN packages each failing package blocks.  Their
+                  # repodata is much bigger than the source repos', so it
+                  # makes every change to the ELN composes slower to load.
+                  'eln' : {'impact' : 'no'},
+                  # How often the daemon refreshes each kind of source, in
+                  # seconds.
+                  'daemon' : {'koji_interval' : '600',
+                              'copr_interval' : '600',
+                              'eln_interval' : '3600'}}
 
 # Exclude clang and llvm packages.
 package_exclude_list = [
@@ -512,145 +2104,540 @@ package_exclude_list = [
     'llvm'
 ]
 
-form = cgi.FieldStorage()
-tags = ['f35', 'f36', 'clang-built-f36']
-if "tag" in form:
-    tag = form['tag'].value
-    if tag in tags:
-        tags = [tag]
-
-use_copr = True
-
-comparisons = [
-(KojiResults('f35'), CoprResults(u'https://copr.fedorainfracloud.org', '@fedora-llvm-team', 'clang-built-f35')),
-(KojiResults('f36'), CoprResults(u'https://copr.fedorainfracloud.org', '@fedora-llvm-team', 'clang-built-f36')),
-(CoprResults(u'https://copr.fedorainfracloud.org', '@fedora-llvm-team', 'clang-built-f35'), CoprResults(u'https://copr.fedorainfracloud.org', '@fedora-llvm-team', 'clang-built-f36')),
-]
-
-# Assume copr-reporter is in the current directory
-
-if len(tags) !=1 and os.path.isdir('./copr-reporter'):
-
-    pages = ['f36']
-
-    print("COPR REPORTER", pages)
-    old_cwd = os.getcwd()
-    os.chdir('./copr-reporter')
-
-    for p in pages:
-        print("COPR REPORTER", p)
-        subprocess.call('python3 ./json_generator.py {}.ini'.format(p), shell = True)
-        subprocess.call('python3 ./html_generator.py', shell = True)
-        subprocess.call('cp report.html {}/copr-reporter-{}.html'.format(old_cwd, p), shell = True)
-
-    os.chdir(old_cwd)
-
-for results in comparisons:
-    stats = Stats()
-
-    file_prefix = results[0].get_file_prefix(True)
-    if not file_prefix:
-        file_prefix = results[1].get_file_prefix(False)
-
-    if file_prefix not in tags:
-        continue
-
-    baseline_pkgs = results[0].packages
-    test_pkgs = results[1].packages
-
-    # Filter out packages form exclude list
-    baseline_pkgs = baseline_pkgs.result()
-    for p in package_exclude_list:
-        if p in baseline_pkgs:
-            del baseline_pkgs[p]
-
-    pkg_compare_list = []
-    for p in sorted(baseline_pkgs.keys()):
-        pkg_compare_list.append(PkgCompare(baseline_pkgs[p]))
-
-    stats.num_fedora_pkgs = len(pkg_compare_list)
-    test_pkgs = test_pkgs.result()
+def load_config(filename = 'update.ini'):
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULT_CONFIG)
+    config.read(filename)
+    return config
+
+# All that's needed to queue and poll jobs.
+def setup_config(run_config):
+    global config, cache_dir
+    config = run_config
+    cache_dir = os.path.abspath(config['cache']['dir'])
+    os.makedirs(cache_dir, exist_ok = True)
+
+# Set up the state shared by everything in a run.
+def setup(run_config):
+    global metrics, executors, fixtures, history, \
+           clang_gcc_br_pkgs_fedora, clang_gcc_br_pkgs_lock, impact_graph
+    setup_config(run_config)
+    metrics = Metrics()
+
+    history = None
+    if config['history']['file']:
+        history = History(os.path.join(cache_dir, config['history']['file']))
+
+    fixtures = None
+    if config['replay']['mode']:
+        fixtures = Fixtures(config['replay']['file'], config['replay']['mode'])
+
+    # Separate pools so that the number of concurrent requests can be limited
+    # per server.
+    executors = {
+        'koji' : concurrent.futures.ThreadPoolExecutor(max_workers = config.getint('concurrency', 'koji')),
+        'copr' : concurrent.futures.ThreadPoolExecutor(max_workers = config.getint('concurrency', 'copr')),
+        'dnf' : concurrent.futures.ThreadPoolExecutor(max_workers = 1),
+        # For tasks that only wait on the other pools.
+        'jobs' : concurrent.futures.ThreadPoolExecutor(max_workers = 8)
+    }
+
+    clang_gcc_br_pkgs_fedora = None
+    clang_gcc_br_pkgs_lock = threading.Lock()
+    impact_graph = None
+
+# The ELN BuildRequires set is only loaded once something needs it.
+def get_clang_gcc_br_pkgs():
+    with clang_gcc_br_pkgs_lock:
+        if not clang_gcc_br_pkgs_fedora:
+            refresh_clang_gcc_br_pkgs()
+        return clang_gcc_br_pkgs_fedora
+
+def refresh_clang_gcc_br_pkgs():
+    global clang_gcc_br_pkgs_fedora
+    clang_gcc_br_pkgs_fedora = executors['dnf'].submit(get_gcc_clang_users_fedora)
+
+def shutdown():
+    for e in executors.values():
+        e.shutdown(True)
+    if fixtures:
+        fixtures.save()
+
+def compare_packages(baseline_pkgs, test_pkgs, package_base_link, notes = None, use_copr = True):
+    classification = Classification(baseline_pkgs, test_pkgs, notes)
+    return classification.get_stats(), classification.get_views(package_base_link, use_copr)
+
+def update_comparison(comparison, fingerprints, checked, checked_time):
+    file_prefix = comparison.name
+
+    with metrics.phase('wait_packages', file_prefix):
+        comparison.baseline.packages.result()
+        comparison.test.packages.result()
+
+    # Filter out packages form exclude list.  The package dicts are shared
+    # with other comparisons, so don't modify them.
+    baseline_pkgs = {name : pkg for name, pkg in comparison.baseline.packages.result().items()
+                     if name not in package_exclude_list}
+    test_pkgs = comparison.test.packages.result()
 
     if len(baseline_pkgs) == 0 or len(test_pkgs) == 0:
         print('Failed:', file_prefix, file = sys.stderr)
-        f = open('{}-status.html'.format(file_prefix), 'w')
-        f.write(get_html_header())
-        f.write('Failed to load package lists')
-        f.write("""
-          <form style="display: inline;" action="update.py">
-            <input type="hidden" name="tag" value="{}" />
-            <input type="submit" value="Update">
-          </form>""")
-        f.write("</body></html>")
-        f.close()
-        continue
-
-    for c in pkg_compare_list:
-
-        c.package_base_link = results[1].get_package_base_link()
-
-        test_pkg = test_pkgs.get(c.pkg.name, None)
-        if not test_pkg:
-            stats.num_missing += 1
+        write_file('{}-status.html'.format(file_prefix), render_failed_page(file_prefix))
+        fingerprints.pop(file_prefix, None)
+        return
+
+    # Only the Koji pages link to the clang Koji builds.
+    clang_builds = {}
+    if config['clang_koji']['hub'] and not comparison.uses_copr():
+        with metrics.phase('clang_koji_builds', file_prefix) as m:
+            clang_builds = get_clang_koji_builds([pkg for name, pkg in baseline_pkgs.items()
+                                                  if name not in test_pkgs or not test_pkgs[name].build_passes])
+            m.items = len(clang_builds)
+
+    stale = [(get_source_label(source), source.stale) for source in comparison if source.stale]
+
+    # Nothing on the page can change unless its inputs do.
+    fingerprint = get_fingerprint(baseline_pkgs, test_pkgs, get_clang_gcc_br_pkgs().result(), clang_builds, stale)
+    checked[file_prefix] = {'checked' : checked_time, 'changed' : True}
+    if fingerprints.get(file_prefix) == fingerprint and os.path.exists('{}-status.html'.format(file_prefix)):
+        print(file_prefix, 'unchanged', file = sys.stderr)
+        checked[file_prefix]['changed'] = False
+        return
+
+    with metrics.phase('compare', file_prefix) as m:
+        stats, pkg_compare_list = compare_packages(baseline_pkgs, test_pkgs,
+                                                   comparison.test.get_package_base_link(),
+                                                   use_copr = comparison.uses_copr())
+        for c in pkg_compare_list:
+            c.clang_build = clang_builds.get(c.pkg.name)
+        m.items = len(pkg_compare_list)
+
+    if impact_graph:
+        with metrics.phase('impact', file_prefix) as m:
+            blocked = [c for c in pkg_compare_list
+                       if c.get_other_pkg_status() in (PkgCompare.STATUS_REGRESSION, PkgCompare.STATUS_FAILED,
+                                                       PkgCompare.STATUS_MISSING)]
+            impact = impact_graph.get_impact([c.pkg.name for c in blocked])
+            for c in blocked:
+                c.impact = impact.get(c.pkg.name)
+            m.items = len(blocked)
+
+    if history:
+        with metrics.phase('history', file_prefix):
+            history.add_run(file_prefix, int(time.time()), stats, pkg_compare_list)
+
+    with metrics.phase('render', file_prefix) as m:
+        snapshot = get_snapshot(file_prefix, stats, pkg_compare_list)
+        previous = read_json('{}-status.json'.format(file_prefix))
+        if previous and previous.get('version') == SNAPSHOT_VERSION:
+            changes = get_changes(previous, snapshot)
+            if has_changes(changes):
+                update_changes_feed(file_prefix, changes)
+        write_json('{}-status.json'.format(file_prefix), snapshot)
+        write_status_page(file_prefix, stats, pkg_compare_list, stale)
+        m.items = len(pkg_compare_list)
+    fingerprints[file_prefix] = fingerprint
+
+def get_time_string():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Start the copr-reporter pages of the comparisons, except for those that
+# are still running in jobs, which maps each page to its job.
+def start_copr_reporter(comparisons, fingerprints, jobs):
+    # Assume copr-reporter is in the current directory
+    if os.path.isdir(COPR_REPORTER_DIR):
+        for comparison in comparisons:
+            page = comparison.copr_reporter
+            if page and page not in jobs:
+                jobs[page] = executors['jobs'].submit(run_copr_reporter, page, comparison,
+                                                      fingerprints.get('copr-reporter-{}'.format(page)))
+
+# Store the fingerprints of the finished copr-reporter jobs and remove them
+# from jobs.  Only the thread that owns fingerprints calls this, so it is
+# never changed while being saved.  Returns whether any job finished.
+def finish_copr_reporter(jobs, fingerprints):
+    finished = [page for page, job in jobs.items() if job.done()]
+    for page in finished:
+        try:
+            fingerprint = jobs.pop(page).result()
+        except Exception as e:
+            print("COPR REPORTER", page, str(e), file = sys.stderr)
             continue
+        if fingerprint:
+            fingerprints['copr-reporter-{}'.format(page)] = fingerprint
+    return bool(finished)
+
+# Jobs for different pages can finish at the same time, so only the
+# entries for keys are written over what is saved.
+def save_state(fingerprints, checked, keys):
+    with jobs_lock():
+        for filename, state in [(os.path.join(cache_dir, 'fingerprints.json'), fingerprints),
+                                ('last-checked.json', checked)]:
+            saved = read_json(filename) or {}
+            for key in keys:
+                if key in state:
+                    saved[key] = state[key]
+                else:
+                    saved.pop(key, None)
+            write_json(filename, saved)
+    metrics.write()
+
+def update_pages(tags):
+    sources = Sources()
+    comparisons = [c for c in get_comparisons(sources) if c.name in tags]
+
+    # Start fetching everything the requested pages need.
+    for comparison in comparisons:
+        comparison.baseline.packages
+        comparison.test.packages
+
+    fingerprints = read_json(os.path.join(cache_dir, 'fingerprints.json')) or {}
+    checked = read_json('last-checked.json') or {}
+    checked_time = get_time_string()
+
+    copr_reporter_jobs = {}
+    if len(tags) !=1:
+        start_copr_reporter(comparisons, fingerprints, copr_reporter_jobs)
+    keys = list(tags) + ['copr-reporter-{}'.format(page) for page in copr_reporter_jobs]
+
+    for comparison in comparisons:
+        update_comparison(comparison, fingerprints, checked, checked_time)
+
+    concurrent.futures.wait(copr_reporter_jobs.values())
+    finish_copr_reporter(copr_reporter_jobs, fingerprints)
+
+    write_index_page()
+    save_state(fingerprints, checked, keys)
+
+def get_daemon_file():
+    return os.path.join(cache_dir, 'daemon.json')
+
+# The daemon rewrites its status file every few seconds, so a stale file
+# means it is not running.
+def is_daemon_running():
+    status = read_json(get_daemon_file())
+    return bool(status) and time.time() - status['updated'] < 30
+
+# Keep the status file fresh from its own thread, a page update can block
+# the daemon's loop for much longer than the status file stays fresh.
+def start_heartbeat():
+    def beat():
+        while True:
+            write_json(get_daemon_file(), {'pid' : os.getpid(), 'updated' : time.time()})
+            time.sleep(5)
+    threading.Thread(target = beat, daemon = True).start()
+
+# Page refreshes asked for through the CGI interface are queued as jobs,
+# one JSON file per job in the jobs directory.
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+def get_jobs_dir():
+    return os.path.join(cache_dir, 'jobs')
+
+def get_job_file(job_id):
+    return os.path.join(get_jobs_dir(), '{}.json'.format(job_id))
+
+def read_job(job_id):
+    if not re.match('^[0-9a-f]+$', job_id):
+        return None
+    return read_json(get_job_file(job_id))
+
+def write_job(job):
+    write_json(get_job_file(job['id']), job)
+
+def set_job_state(job, state, error = None):
+    job['state'] = state
+    job[state] = get_time_string()
+    if error:
+        job['error'] = error
+    write_job(job)
+
+def list_jobs():
+    jobs = []
+    for filename in os.listdir(get_jobs_dir()):
+        if filename.endswith('.json'):
+            job = read_json(os.path.join(get_jobs_dir(), filename))
+            if job:
+                jobs.append(job)
+    return jobs
+
+@contextlib.contextmanager
+def jobs_lock():
+    os.makedirs(get_jobs_dir(), exist_ok = True)
+    with open(os.path.join(get_jobs_dir(), 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def get_job_log(job_id):
+    return os.path.join(get_jobs_dir(), '{}.log'.format(job_id))
+
+# A queued or running job will never finish if the process it was handed to
+# is gone, if it was left for the daemon and the daemon is gone, or if it
+# has been at it for longer than job_timeout.
+def is_job_dead(job):
+    if time.time() - os.path.getmtime(get_job_file(job['id'])) > config.getint('cgi', 'job_timeout'):
+        return True
+    if not job.get('pid'):
+        return not is_daemon_running()
+    try:
+        os.kill(job['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+# Queue a refresh of the tags' pages, and start a worker for it unless the
+# daemon will pick it up.  If a queued or running job already covers all of
+# them, return that job instead.  Returns the job and whether it is new.
+def submit_job(tags):
+    with jobs_lock():
+        for job in list_jobs():
+            if job['state'] in [JOB_QUEUED, JOB_RUNNING] and is_job_dead(job):
+                set_job_state(job, JOB_FAILED, 'Job timed out or its worker died')
+            if job['state'] in [JOB_QUEUED, JOB_RUNNING] and set(tags) <= set(job['tags']):
+                return job, False
+            # Forget about finished jobs after a day.
+            if job['state'] in [JOB_DONE, JOB_FAILED] and os.path.getmtime(get_job_file(job['id'])) < time.time() - 86400:
+                os.unlink(get_job_file(job['id']))
+                if os.path.exists(get_job_log(job['id'])):
+                    os.unlink(get_job_log(job['id']))
+        job = {'id' : uuid.uuid4().hex, 'tags' : tags}
+        if not is_daemon_running():
+            job['pid'] = start_job_worker(job)
+        set_job_state(job, JOB_QUEUED)
+        return job, True
+
+# Run a job in its own process, so the CGI request can return right away.
+# The worker waits for the jobs lock before reading its job, so the job is
+# always written by then.  Returns the worker's pid.
+def start_job_worker(job):
+    with open(get_job_log(job['id']), 'w') as log:
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--job', job['id']],
+                             stdin = subprocess.DEVNULL, stdout = log, stderr = log,
+                             start_new_session = True)
+    return p.pid
+
+def run_job(job_id):
+    with jobs_lock():
+        job = read_job(job_id)
+        if not job:
+            print('Unknown job:', job_id, file = sys.stderr)
+            return
+        job['pid'] = os.getpid()
+        set_job_state(job, JOB_RUNNING)
+    try:
+        update_pages(job['tags'])
+    except Exception as e:
+        set_job_state(job, JOB_FAILED, str(e))
+        raise
+    set_job_state(job, JOB_DONE)
+
+# Keep the sources and their package lists in memory, refresh each source
+# when its interval runs out or a page using it is requested, and rebuild
+# the pages that use whatever was refreshed.
+def run_daemon():
+    sources = Sources()
+    comparisons = get_comparisons(sources)
+    write_index_page()
+    fingerprints = read_json(os.path.join(cache_dir, 'fingerprints.json')) or {}
+    checked = read_json('last-checked.json') or {}
+    next_refresh = {}
+    next_eln_refresh = time.time() + config.getint('daemon', 'eln_interval')
+    pending = set()
+    copr_reporter_jobs = {}
+    keys = [comparison.name for comparison in comparisons] + \
+           ['copr-reporter-{}'.format(comparison.copr_reporter) for comparison in comparisons
+            if comparison.copr_reporter]
+
+    # Running jobs, the pages each one is still waiting for and the pages
+    # that failed.
+    jobs = {}
+
+    start_heartbeat()
+    while True:
+        now = time.time()
+
+        refresh = set()
+        with jobs_lock():
+            queued = [job for job in list_jobs() if job['state'] == JOB_QUEUED]
+            for job in queued:
+                job['pid'] = os.getpid()
+                set_job_state(job, JOB_RUNNING)
+        for job in queued:
+            jobs[job['id']] = (job, set(job['tags']), [])
+            for comparison in comparisons:
+                if comparison.name in job['tags']:
+                    refresh.update(comparison)
+        for comparison in comparisons:
+            for source in comparison:
+                if next_refresh.get(source, 0) <= now:
+                    refresh.add(source)
+
+        if next_eln_refresh <= now:
+            refresh_clang_gcc_br_pkgs()
+            next_eln_refresh = now + config.getint('daemon', 'eln_interval')
+            refresh.update(sources.sources.values())
+
+        for source in refresh:
+            print('Refreshing', get_source_label(source), file = sys.stderr)
+            source.refresh()
+            next_refresh[source] = now + config.getint('daemon', '{}_interval'.format(source.kind))
+        pending.update(comparison for comparison in comparisons if refresh.intersection(comparison))
+
+        # Rebuild each page once both of its package lists are in.
+        ready = [comparison for comparison in pending
+                 if comparison.baseline.packages.done() and comparison.test.packages.done()]
+        for comparison in ready:
+            pending.discard(comparison)
+            error = None
+            try:
+                update_comparison(comparison, fingerprints, checked, get_time_string())
+            except Exception as e:
+                print(comparison.name, str(e), file = sys.stderr)
+                error = '{}: {}'.format(comparison.name, str(e))
+            for job, waiting, errors in list(jobs.values()):
+                if comparison.name not in waiting:
+                    continue
+                waiting.discard(comparison.name)
+                if error:
+                    errors.append(error)
+                if not waiting:
+                    if errors:
+                        set_job_state(job, JOB_FAILED, '\n'.join(errors))
+                    else:
+                        set_job_state(job, JOB_DONE)
+                    del jobs[job['id']]
+        # A page whose report is still running is left for a later refresh.
+        finished = finish_copr_reporter(copr_reporter_jobs, fingerprints)
+        start_copr_reporter(ready, fingerprints, copr_reporter_jobs)
+        if ready or finished:
+            save_state(fingerprints, checked, keys)
+            metrics.reset()
+
+        time.sleep(1)
+
+JOB_PAGE = """<!DOCTYPE HTML>
+<html>
+  <head>
+  </head>
+  <body>
+    Update <span id='job_state'>{state}</span>
+    <a href="{redirect}">View Current Page</a>
+    <script>
+      function poll() {{
+        fetch('update.py?job={job_id}').then(function(response) {{
+          return response.json();
+        }}).then(function(job) {{
+          document.getElementById('job_state').innerHTML = job.state;
+          if (job.state == 'done') {{
+            window.location = '{redirect}';
+          }} else if (job.state != 'failed') {{
+            setTimeout(poll, 5000);
+          }}
+        }});
+      }}
+      setTimeout(poll, 5000);
+    </script>
+  </body>
+</html>"""
+
+def main():
+    if '--daemon' in sys.argv[1:]:
+        setup(load_config())
+        run_daemon()
+        return
+
+    if '--job' in sys.argv[1:]:
+        setup(load_config())
+        run_job(sys.argv[sys.argv.index('--job') + 1])
+        shutdown()
+        return
+
+    if '--history' in sys.argv[1:]:
+        setup(load_config())
+        print_package_history(sys.argv[sys.argv.index('--history') + 1])
+        shutdown()
+        return
+
+    # When run from the command line, just update everything.
+    if 'GATEWAY_INTERFACE' not in os.environ:
+        setup(load_config())
+        update_pages(get_page_names())
+        shutdown()
+        return
 
-        if test_pkg.build_passes:
-            stats.num_clang_pkgs += 1
-            stats.num_pass_or_note += 1
-        elif c.note:
-            stats.num_pass_or_note +=1
-
-        c.add_other_pkg(test_pkg)
-        if c.is_up_to_date():
-            stats.num_up_to_date_pkgs += 1
-
-        status = c.get_other_pkg_status()
-        if status == c.STATUS_REGRESSION:
-            stats.num_regressions += 1
-        elif status == c.STATUS_FIXED:
-            stats.num_fixed += 1
-
-    f = open('{}-status.html'.format(file_prefix), 'w')
-    f.write(get_html_header())
-
-    f.write("""
-    <a href='f35-status.html'>Fedora 35</a>
-    <a href='f36-status.html'>Fedora 36</a>
-    <a href='clang-built-f36-status.html'>Clang f35 vs f36</a>(<a href='copr-reporter-f36.html'>Detailed</a>)
-    """)
-
-    f.write(stats.html_table())
-    f.write("""
-        <form style="display: inline;" action="update.py">
-          <input type="hidden" name="tag" value="{}" />
-          <input type="submit" value="Update">
-        </form>
-          <div class="last_updated">Last Updated: <div id='timestamp' style="display: inline-block;">{}</div></div>
-            <script>
-              var date = new Date(document.getElementById("timestamp").innerHTML);
-              document.getElementById("timestamp").innerHTML = date.toString();
-            </script>""".format(file_prefix, datetime.datetime.utcnow().strftime("%m/%d/%Y %H:%M:%S UTC")))
-    f.write("""
-        <table>
-          <tr><th colspan='2'>Fedora</th><th colspan='4'>Fedora Clang</th></tr>
-          <tr><th colspan='2'>Latest Build</th><th>Latest Build</th><th>Latest Success</th><th></th><th>Notes</th>""")
-    for index, c in enumerate(pkg_compare_list):
-        f.write(c.html_row(index))
-    f.write("</table></body></html>")
+    try:
+        handle_request()
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        print("Status: 500 Internal Server Error")
+        print("Content-Type: text/plain")
+        print("")
+        print("Internal error")
+
+def get_field(form, name):
+    values = form.get(name)
+    return values[0] if values else None
+
+# The time the least recently checked of the pages was checked, or None if
+# one of them never was.
+def get_checked_time(tags):
+    checked = read_json('last-checked.json') or {}
+    times = [checked.get(tag, {}).get('checked') for tag in tags]
+    if None in times:
+        return None
+    return min(times)
+
+def handle_request():
+    setup_config(load_config())
+    form = urllib.parse.parse_qs(os.environ.get('QUERY_STRING', ''))
+    tags = get_page_names()
+
+    # Job status, polled by the page returned below.
+    if get_field(form, 'job'):
+        print("Content-Type: application/json")
+        print("")
+        print(json.dumps(read_job(get_field(form, 'job')) or {'state' : 'unknown'}))
+        return
+
+    tag = get_field(form, 'tag')
+    if tag in tags:
+        tags = [tag]
 
-    f.close()
+    page_redirect='index.html'
+    if len(tags) == 1:
+        page_redirect="{}-status.html".format(tags[0])
+
+    # Pages that were checked a moment ago are sent back as they are.
+    checked = get_checked_time(tags)
+    fresh_time = datetime.datetime.utcnow() - datetime.timedelta(seconds = config.getint('cgi', 'fresh_seconds'))
+    if checked and checked >= fresh_time.strftime("%Y-%m-%dT%H:%M:%SZ"):
+        if get_field(form, 'format') == 'json':
+            print("Content-Type: application/json")
+            print("")
+            print(json.dumps({'tags' : tags, 'state' : JOB_DONE, 'checked' : checked}))
+        else:
+            print("Status: 303 See Other")
+            print("Location: {}".format(page_redirect))
+            print("")
+        return
 
-status_mutex.acquire()
-executor.shutdown(True)
+    job, _ = submit_job(tags)
 
-page_redirect='index.html'
-if len(tags) == 1:
-    page_redirect="{}-status.html".format(tags[0])
+    if get_field(form, 'format') == 'json':
+        print("Content-Type: application/json")
+        print("")
+        print(json.dumps(job))
+        return
 
-print ("""
-    <meta http-equiv="refresh" content="0; url={redirect}">
-  </head>
-  <body>
-    <a href="{redirect}">View Updated Page</a>
-  </body>
-</html>""".format(redirect = page_redirect))
+    print("Content-Type: text/html")
+    print("")
+    print(JOB_PAGE.format(state = job['state'], redirect = page_redirect, job_id = job['id']))
+
+if __name__ == '__main__':
+    main()